@@ -1,13 +1,25 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import pandas as pd
-import io
+import numpy as np
+import os
 import json
+import tempfile
+import re
+import heapq
+from collections import Counter
+import hashlib
 import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
-import boto3
-from botocore.exceptions import NoCredentialsError
-from PIL import Image
+from botocore.exceptions import ClientError
+from google.api_core import exceptions as gcp_exceptions
+from export_logs import export_logs, count_logs, iter_log_chunks
+from r2_client import r2_client_from_conf, R2_MAX_POOL_CONNECTIONS
+from image_utils import render_product_images, IMAGE_MAX_WIDTH
+from image_cache import DiskImageCache
 from datetime import datetime, timedelta, timezone, date
 
 # Firebase 相關套件
@@ -110,6 +122,30 @@ except Exception as e:
 
 COLLECTION_products = "instrument_consumables" 
 COLLECTION_logs = "consumables_logs"
+COLLECTION_tombstones = "consumables_tombstones"  # 刪除標記，供增量同步得知已刪除的 SKU
+COLLECTION_rollups = "consumables_rollups"  # 每日 × SKU × 地點的入出庫彙總
+
+# 目錄同步設定
+CATALOG_COLUMNS = ["SKU", "Code", "Category", "Number", "Name", "ImageFile", "Stock", "Location", "SN", "WarrantyStart", "WarrantyEnd", "Accessories", "ItemType"]
+# 載入時物化的衍生欄位：解析後的配件、配件摘要、庫存等級、保固狀態
+MAP_COLUMNS = ["ImageVariants"]  # 以 map 儲存、不參與 CSV 匯入的欄位
+DERIVED_COLUMNS = ["AccDict", "AccSummary", "StockTier", "WarrantyStatus"]
+LOW_STOCK_THRESHOLD = 5
+CATALOG_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+CATALOG_SYNC_OVERLAP = timedelta(seconds=5)
+CATALOG_SYNC_INTERVAL = 300  # 增量同步最短間隔（秒），寫入會直接修補快取，不必等待
+CATALOG_FULL_SYNC_INTERVAL = 3600  # 每小時完整重載一次，修正任何遺漏的差異
+CATALOG_LISTENER_TIMEOUT = 30  # 等待監聽器第一次快照的秒數，逾時改用增量輪詢
+
+def get_secret(section, key, default=None):
+    """讀取選用設定，未設定時回傳預設值"""
+    try:
+        return st.secrets.get(section, {}).get(key, default)
+    except Exception:
+        return default
+
+# 目錄模式："delta"（增量輪詢）或 "listener"（on_snapshot 即時監聽，所有 session 共用）
+CATALOG_MODE = get_secret("catalog", "mode", "delta")
 
 # --- 3. UI 設計：日式清爽文青風格 ---
 st.markdown("""
@@ -357,51 +393,319 @@ def get_taiwan_time():
     tz = timezone(timedelta(hours=8))
     return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
 
-@st.cache_data(ttl=300)
-def load_data():
+# Firestore 欄位 → 目錄欄位
+FIELD_TO_COLUMN = {
+    "code": "Code", "categoryName": "Category", "number": "Number", "name": "Name",
+    "imageFile": "ImageFile", "stock": "Stock", "location": "Location", "sn": "SN",
+    "warrantyStart": "WarrantyStart", "warrantyEnd": "WarrantyEnd",
+    "accessories": "Accessories", "itemType": "ItemType", "imageVariants": "ImageVariants"
+}
+
+def _doc_to_row(doc):
+    """Firestore 文件 → 目錄列"""
+    return _dict_to_row(doc.id, doc.to_dict() or {})
+
+def _dict_to_row(sku, d):
+    return _with_derived({
+        "SKU": sku,
+        "Code": d.get("code", ""),
+        "Category": d.get("categoryName", ""),
+        "Number": d.get("number", ""),
+        "Name": d.get("name", ""),
+        "ImageFile": d.get("imageFile", ""),
+        "Stock": d.get("stock", 0),
+        "Location": d.get("location", ""),
+        "SN": d.get("sn", ""),
+        "WarrantyStart": d.get("warrantyStart", ""),
+        "WarrantyEnd": d.get("warrantyEnd", ""),
+        "Accessories": d.get("accessories", ""),
+        "ItemType": d.get("itemType", "儀器"),
+        "ImageVariants": d.get("imageVariants") or {}
+    })
+
+def _with_derived(row):
+    """文件載入（或修補）時解析一次配件，渲染時不必再 json.loads"""
+    acc = row.get("Accessories")
+    row["AccDict"] = accessories_to_map(acc)
+    # Accessories 欄位維持 JSON 字串，供搜尋索引、編輯與 CSV 使用
+    if isinstance(acc, dict):
+        row["Accessories"] = json.dumps(acc, ensure_ascii=False) if acc else ""
+    row["AccSummary"] = summarize_accessories(row["AccDict"])
+    return row
+
+def _add_daily_columns(df, today):
+    """與日期有關的衍生欄位，每天需重新計算一次"""
+    df["WarrantyStatus"] = compute_warranty_status(df["WarrantyEnd"], today)[1]
+    return df
+
+def _rows_to_frame(rows):
+    """將目錄列轉為 DataFrame 並統一欄位型別，同時物化渲染用的衍生欄位"""
+    if not rows: return pd.DataFrame(columns=CATALOG_COLUMNS + MAP_COLUMNS + DERIVED_COLUMNS)
+    df = pd.DataFrame(rows)
+    for col in CATALOG_COLUMNS:
+        if col not in df.columns: df[col] = ""
+
+    df["WarrantyStart"] = pd.to_datetime(df["WarrantyStart"], errors='coerce')
+    df["WarrantyEnd"] = pd.to_datetime(df["WarrantyEnd"], errors='coerce')
+    df["Stock"] = pd.to_numeric(df["Stock"], errors='coerce').fillna(0).astype(int)
+    df["StockTier"] = np.select([df["Stock"] <= 0, df["Stock"] <= LOW_STOCK_THRESHOLD], ["無庫存", "低庫存"], "")
+    return _add_daily_columns(df, get_taiwan_date())
+
+def _max_updated_at(docs, current):
+    """取得文件中最新的 updatedAt 作為新水位線"""
+    for doc in docs:
+        ts = (doc.to_dict() or {}).get("updatedAt")
+        if isinstance(ts, datetime) and ts > current:
+            current = ts
+    return current
+
+@st.cache_resource
+def _catalog_state():
+    """跨 session 共用的目錄快取：最後一次物化的 DataFrame 與同步水位線"""
+    return {
+        "lock": threading.Lock(),
+        "df": None,
+        "watermark": CATALOG_EPOCH,
+        "synced_at": 0.0,
+        "full_synced_at": 0.0,
+        "version": 0,
+        "derived_date": None
+    }
+
+def _full_sync(state):
+    docs = list(db.collection(COLLECTION_products).stream())
+    state["df"] = _rows_to_frame([_doc_to_row(doc) for doc in docs])
+    state["derived_date"] = get_taiwan_date()
+    state["version"] += 1
+    state["watermark"] = _max_updated_at(docs, CATALOG_EPOCH)
+    state["synced_at"] = state["full_synced_at"] = time.time()
+    return state["df"]
+
+def _delta_sync(state):
+    # 水位線往回退一小段，避免漏掉提交順序與時間戳不一致的寫入（重複套用無副作用）
+    since = state["watermark"] - CATALOG_SYNC_OVERLAP
+    removed = [doc.id for doc in db.collection(COLLECTION_tombstones).where("deletedAt", ">", since).stream()]
+    changed_docs = list(db.collection(COLLECTION_products).where("updatedAt", ">", since).stream())
+    state["synced_at"] = time.time()
+    if not removed and not changed_docs:
+        return state["df"]
+
+    # 先移除刪除標記與異動的舊列，再合併異動後的新列（同一 SKU 刪除後又重建時以現存文件為準）
+    changed = _rows_to_frame([_doc_to_row(doc) for doc in changed_docs])
+    drop = set(removed) | set(changed["SKU"])
+    df = state["df"]
+    df = df[~df["SKU"].isin(drop)]
+    if df.empty:
+        df = changed
+    elif not changed.empty:
+        df = pd.concat([df, changed], ignore_index=True)
+    # 與 Firestore stream 相同，依文件 ID 排序
+    state["df"] = df.sort_values("SKU", kind="stable", ignore_index=True)
+    state["version"] += 1
+    state["watermark"] = _max_updated_at(changed_docs, state["watermark"])
+    return state["df"]
+
+def sync_catalog():
+    """增量同步產品目錄：只讀取水位線之後異動的文件與刪除標記，定期完整重載
+
+    回傳 (DataFrame, 版本)。
+    """
+    state = _catalog_state()
+    with state["lock"]:
+        now = time.time()
+        if state["df"] is None or now - state["full_synced_at"] > CATALOG_FULL_SYNC_INTERVAL:
+            _full_sync(state)
+        elif now - state["synced_at"] >= CATALOG_SYNC_INTERVAL:
+            _delta_sync(state)
+        today = get_taiwan_date()
+        if state["derived_date"] != today:
+            state["df"] = _add_daily_columns(state["df"].copy(), today)
+            state["derived_date"] = today
+            state["version"] += 1
+        return state["df"], ("delta", state["version"])
+
+def _patch_catalog_rows(state, updates):
+    """在快取的目錄上直接套用寫入（SKU → 欄位，None 表示刪除），回傳原本的圖片 URL"""
+    df = state["df"]
+    if df is None:
+        return []
+    hit = df["SKU"].isin(list(updates))
+    old = {row["SKU"]: row for row in df[hit].to_dict("records")}
+    rows = []
+    for sku, fields in updates.items():
+        if fields is None:
+            continue
+        row = old.get(sku) or _dict_to_row(sku, {})
+        for field, value in fields.items():
+            if field in FIELD_TO_COLUMN:
+                row[FIELD_TO_COLUMN[field]] = value
+        rows.append(_with_derived(row))
+    df = df[~hit]
+    if rows:
+        patched = _rows_to_frame(rows)
+        df = patched if df.empty else pd.concat([df, patched], ignore_index=True)
+    state["df"] = df.sort_values("SKU", kind="stable", ignore_index=True)
+    state["version"] += 1
+    return [row["ImageFile"] for row in old.values()]
+
+class LiveCatalog:
+    """由 on_snapshot 監聽器即時維護的全域產品目錄
+
+    source 只需提供 on_snapshot(callback)，測試時可換成自行送出異動事件的假來源。
+    """
+
+    def __init__(self, source):
+        self._source = source
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._rows = {}
+        self._version = 0
+        self._df = None
+        self._df_version = -1
+        self._df_date = None
+        self._subscribe()
+
+    def _subscribe(self):
+        self._resync = True
+        self._watch = self._source.on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            if self._resync:
+                # 第一次（或重新訂閱後）的快照即完整目錄，直接取代以免殘留重連期間刪除的項目
+                self._rows = {doc.id: _doc_to_row(doc) for doc in docs}
+                self._resync = False
+            else:
+                for change in changes:
+                    if change.type.name == "REMOVED":
+                        self._rows.pop(change.document.id, None)
+                    else:
+                        self._rows[change.document.id] = _doc_to_row(change.document)
+            self._version += 1
+        self._ready.set()
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, sku):
+        with self._lock:
+            return self._rows.get(sku)
+
+    def wait_ready(self, timeout=None):
+        # 監聽器因錯誤關閉時重新訂閱
+        if getattr(self._watch, "_closed", False):
+            with self._lock:
+                self._subscribe()
+        return self._ready.wait(timeout)
+
+    def snapshot(self):
+        """回傳 (目前目錄的 DataFrame, 版本)；DataFrame 唯讀，版本未變時重複使用同一份"""
+        with self._lock:
+            today = get_taiwan_date()
+            if self._df_date != today:
+                # 跨日時保固狀態需要重算
+                self._df_date = today
+                self._version += 1
+            if self._df_version != self._version:
+                self._df = _rows_to_frame([self._rows[sku] for sku in sorted(self._rows)])
+                self._df_version = self._version
+            return self._df, ("listener", self._df_version)
+
+    def close(self):
+        self._watch.unsubscribe()
+
+@st.cache_resource
+def get_live_catalog():
+    return LiveCatalog(db.collection(COLLECTION_products))
+
+def _load_data_polling():
     try:
-        docs = db.collection(COLLECTION_products).stream()
-        data = []
-        for doc in docs:
-            d = doc.to_dict()
-            data.append({
-                "SKU": doc.id,
-                "Code": d.get("code", ""),
-                "Category": d.get("categoryName", ""),
-                "Number": d.get("number", ""),
-                "Name": d.get("name", ""),
-                "ImageFile": d.get("imageFile", ""),
-                "Stock": d.get("stock", 0),
-                "Location": d.get("location", ""),
-                "SN": d.get("sn", ""),
-                "WarrantyStart": d.get("warrantyStart", ""),
-                "WarrantyEnd": d.get("warrantyEnd", ""),
-                "Accessories": d.get("accessories", ""),
-                "ItemType": d.get("itemType", "儀器")
-            })
-        
-        default_cols = ["SKU", "Code", "Category", "Number", "Name", "ImageFile", "Stock", "Location", "SN", "WarrantyStart", "WarrantyEnd", "Accessories", "ItemType"]
-        if not data: return pd.DataFrame(columns=default_cols)
-        df = pd.DataFrame(data)
-        for col in default_cols:
-            if col not in df.columns: df[col] = ""
-        
-        df["WarrantyStart"] = pd.to_datetime(df["WarrantyStart"], errors='coerce')
-        df["WarrantyEnd"] = pd.to_datetime(df["WarrantyEnd"], errors='coerce')
-        df["Stock"] = pd.to_numeric(df["Stock"], errors='coerce').fillna(0).astype(int)
-        return df
+        return sync_catalog()
     except Exception as e:
         st.error(f"資料讀取錯誤: {e}")
-        return pd.DataFrame(columns=["SKU", "Code", "Category", "Number", "Name", "ImageFile", "Stock", "Location", "SN", "WarrantyStart", "WarrantyEnd", "Accessories", "ItemType"])
+        return _rows_to_frame([]), None
 
-def load_log():
-    try:
-        docs = db.collection(COLLECTION_logs).order_by("timestamp", direction=firestore.Query.DESCENDING).limit(100).stream()
-        data = [doc.to_dict() for doc in docs]
-        if not data: return pd.DataFrame(columns=["Time", "User", "Type", "SKU", "Name", "Quantity", "Note"])
-        return pd.DataFrame(data)
-    except:
-        return pd.DataFrame(columns=["Time", "User", "Type", "SKU", "Name", "Quantity", "Note"])
+def load_catalog():
+    """回傳 (目錄 DataFrame, 版本)；版本隨內容變動而改變，可作為衍生資料的快取鍵"""
+    if CATALOG_MODE == "listener":
+        catalog = get_live_catalog()
+        if catalog.wait_ready(CATALOG_LISTENER_TIMEOUT):
+            return catalog.snapshot()
+    return _load_data_polling()
+
+def load_data():
+    return load_catalog()[0]
+
+def invalidate_product(sku, fields=None, deleted=False):
+    """寫入單一 SKU 後只修補該列與其圖片 URL 快取，不影響其他產品與其他使用者的快取
+
+    fields 為本次寫入的 Firestore 欄位（可為部分欄位，依 merge 語意套用）。
+    """
+    invalidate_products({sku: None if deleted else (fields or {})})
+
+def invalidate_products(updates):
+    """批次版本的 invalidate_product：updates 為 SKU → 欄位（None 表示刪除）"""
+    if CATALOG_MODE == "listener":
+        # 監聽器會自行套用異動，只需找出舊圖片
+        catalog = get_live_catalog()
+        old_imgs = [(catalog.get(sku) or {}).get("ImageFile", "") for sku in updates]
+    else:
+        state = _catalog_state()
+        with state["lock"]:
+            old_imgs = _patch_catalog_rows(state, updates)
+    new_imgs = [fields.get("imageFile") for fields in updates.values() if fields]
+    invalidate_image_url(*old_imgs, *new_imgs)
+
+def invalidate_catalog():
+    """整批異動（例如全部刪除）後重置目錄與圖片 URL 快取"""
+    state = _catalog_state()
+    with state["lock"]:
+        state["df"] = None
+    cache = _image_url_cache()
+    with cache["lock"]:
+        cache["entries"].clear()
+
+LOG_COLUMNS = ["Time", "User", "Type", "SKU", "Name", "Quantity", "Note"]
+LOG_PAGE_SIZE = 50
+LOG_TYPES = ["入庫", "出庫"]
+
+@st.cache_data(ttl=60, max_entries=64)
+def query_logs_page(sku, op_type, start, end, cursor, page_size=LOG_PAGE_SIZE):
+    """以游標分頁讀取異動紀錄（依 timestamp 新到舊），篩選條件皆在 Firestore 端執行
+
+    cursor 為上一頁最後一筆的 (timestamp, 文件 ID)（第一頁為 None），回傳 (DataFrame, 下一頁 cursor 或 None)。
+    批次寫入的多筆紀錄 timestamp 相同，因此再以文件 ID 排序，游標才不會跳過同一時間的紀錄。
+    SKU / Type 等值條件搭配 timestamp 排序需要複合索引：
+    (SKU, timestamp DESC)、(Type, timestamp DESC)、(SKU, Type, timestamp DESC)。
+    """
+    query = db.collection(COLLECTION_logs)
+    if sku:
+        query = query.where("SKU", "==", sku)
+    if op_type:
+        query = query.where("Type", "==", op_type)
+    if start:
+        query = query.where("timestamp", ">=", start)
+    if end:
+        query = query.where("timestamp", "<", end)
+    query = query.order_by("timestamp", direction=firestore.Query.DESCENDING)
+    query = query.order_by("__name__", direction=firestore.Query.DESCENDING)
+    if cursor:
+        ts, doc_id = cursor
+        query = query.start_after({"timestamp": ts, "__name__": doc_id})
+    # 多讀一筆以判斷是否還有下一頁
+    docs = list(query.limit(page_size + 1).stream())
+    next_cursor = None
+    if len(docs) > page_size:
+        last = docs[page_size - 1]
+        next_cursor = (last.get("timestamp"), last.id)
+    rows = [doc.to_dict() for doc in docs[:page_size]]
+    if not rows:
+        return pd.DataFrame(columns=LOG_COLUMNS), None
+    df = pd.DataFrame(rows)
+    for col in LOG_COLUMNS:
+        if col not in df.columns: df[col] = ""
+    return df[LOG_COLUMNS], next_cursor
 
 def save_data_row(row_data):
     ws = row_data.get("WarrantyStart")
@@ -434,16 +738,380 @@ def save_data_row(row_data):
         "sn": str(row_data.get("SN", "")),
         "warrantyStart": ws,
         "warrantyEnd": we,
-        "accessories": str(row_data.get("Accessories", "")),
+        "accessories": accessories_to_map(row_data.get("Accessories", "")),
         "itemType": str(row_data.get("ItemType", "儀器")),
         "updatedAt": firestore.SERVER_TIMESTAMP
     }
-    db.collection(COLLECTION_products).document(sku).set(data_dict, merge=True)
-    st.cache_data.clear()
+    # 只有重新上傳圖片時才帶入縮圖版本，其餘情況保留原值
+    if "ImageVariants" in row_data:
+        data_dict["imageVariants"] = row_data["ImageVariants"] or {}
+    # 以頂層欄位作為 merge 範圍：accessories / imageVariants 為 map，merge=True 會逐鍵合併，
+    # 取消勾選的配件與舊的縮圖格式會一直留在文件中
+    db.collection(COLLECTION_products).document(sku).set(data_dict, merge=list(data_dict))
+    invalidate_product(sku, data_dict)
+
+COLUMN_TO_FIELD = {col: field for field, col in FIELD_TO_COLUMN.items()}
+IMPORT_BATCH_SIZE = 500  # Firestore 單一批次寫入上限
+
+def normalize_import_frame(df):
+    """向量化清理匯入資料，回傳 (SKU → Firestore 欄位, 錯誤清單)
+
+    只寫入檔案中有的欄位（merge），缺少 SKU、SKU 重複或格式錯誤的列會列入錯誤清單並略過。
+    """
+    present = [col for col in CATALOG_COLUMNS if col in df.columns and col != "SKU"]
+    frame = pd.DataFrame(index=df.index)
+    # CSV 列號（含標題列）
+    frame["Row"] = df.index + 2
+    frame["SKU"] = df["SKU"].fillna("").astype(str).str.strip() if "SKU" in df.columns else ""
+    for col in present:
+        if col == "Stock":
+            frame[col] = pd.to_numeric(df[col], errors='coerce')
+        elif col in ("WarrantyStart", "WarrantyEnd"):
+            frame[col] = pd.to_datetime(df[col], errors='coerce', format='mixed')
+        else:
+            frame[col] = df[col].fillna("").astype(str).str.strip()
+
+    bad = pd.Series("", index=frame.index)
+    bad = bad.mask(frame["SKU"].str.contains("/", regex=False), "SKU 不可包含 /")
+    bad = bad.mask(frame["SKU"] == "", "缺少 SKU")
+    if "Stock" in present:
+        bad = bad.mask((bad == "") & frame["Stock"].isna() & df["Stock"].notna(), "庫存不是數字")
+    for col in ("WarrantyStart", "WarrantyEnd"):
+        if col in present:
+            raw = df[col].fillna("").astype(str).str.strip()
+            bad = bad.mask((bad == "") & frame[col].isna() & (raw != ""), f"{col} 日期格式錯誤")
+    # 只在通過驗證的列之間去重，最後一筆格式錯誤時仍匯入前面正確的那筆
+    valid_sku = frame["SKU"].where(bad == "")
+    dup = valid_sku.duplicated(keep="last") & valid_sku.notna()
+    bad = bad.mask(dup, "SKU 重複，以最後一筆為準")
+
+    errors = frame.loc[bad != "", ["Row", "SKU"]].assign(Error=bad[bad != ""]).to_dict("records")
+    frame = frame[bad == ""]
+
+    if "Stock" in present:
+        frame["Stock"] = frame["Stock"].fillna(0).astype(int)
+    for col in ("WarrantyStart", "WarrantyEnd"):
+        if col in present:
+            frame[col] = frame[col].dt.strftime('%Y-%m-%d').fillna("")
+    if "ItemType" in present:
+        frame["ItemType"] = frame["ItemType"].replace("", "儀器")
+    if "Accessories" in present:
+        frame["Accessories"] = frame["Accessories"].map(accessories_to_map)
+
+    docs = frame.set_index("SKU")[present].rename(columns=COLUMN_TO_FIELD).to_dict("index")
+    return docs, errors
+
+def import_products_bulk(df, progress=None):
+    """批次匯入產品：整批驗證後以每批 500 筆寫入，最後只失效一次快取
+
+    回傳 {"written", "errors", "elapsed", "rate"}，progress(done, total) 用於回報進度。
+    """
+    start = time.perf_counter()
+    docs, errors = normalize_import_frame(df)
+    skus = list(docs)
+    written = {}
+    for i in range(0, len(skus), IMPORT_BATCH_SIZE):
+        chunk = skus[i:i + IMPORT_BATCH_SIZE]
+        batch = db.batch()
+        for sku in chunk:
+            data = {**docs[sku], "updatedAt": firestore.SERVER_TIMESTAMP}
+            # 只覆寫檔案中有的頂層欄位，accessories 整個取代而非逐鍵合併
+            batch.set(db.collection(COLLECTION_products).document(sku), data, merge=list(data))
+        try:
+            batch.commit()
+            written.update({sku: docs[sku] for sku in chunk})
+        except Exception as e:
+            errors.extend({"Row": None, "SKU": sku, "Error": f"批次寫入失敗: {e}"} for sku in chunk)
+        if progress:
+            progress(min(i + IMPORT_BATCH_SIZE, len(skus)), len(skus))
+
+    if written:
+        invalidate_products(written)
+    elapsed = time.perf_counter() - start
+    return {
+        "written": len(written),
+        "errors": errors,
+        "elapsed": elapsed,
+        "rate": len(written) / elapsed if elapsed > 0 else 0.0
+    }
+
+IMPORT_CHUNK_ROWS = 5000  # 串流匯入每塊列數
+IMPORT_MAX_ERRORS = 1000  # 保留的錯誤明細上限，避免大檔案的錯誤清單本身佔滿記憶體
+
+def _xlsx_cell(v):
+    if v is None:
+        return None
+    if isinstance(v, (datetime, date)):
+        return v.strftime('%Y-%m-%d')
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+def _iter_xlsx_chunks(uploaded_file, chunksize):
+    from openpyxl import load_workbook
+    wb = load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        total = max((ws.max_row or 0) - 1, 1)
+        rows = ws.iter_rows(values_only=True)
+        header = [str(c).strip() if c is not None else "" for c in next(rows, ())]
+        buf, start = [], 0
+        for row in rows:
+            buf.append([_xlsx_cell(v) for v in row[:len(header)]])
+            if len(buf) >= chunksize:
+                yield pd.DataFrame(buf, columns=header, index=range(start, start + len(buf))), (start + len(buf)) / total
+                start += len(buf)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=header, index=range(start, start + len(buf))), 1.0
+    finally:
+        wb.close()
+
+def _iter_csv_chunks(uploaded_file, chunksize):
+    size = getattr(uploaded_file, "size", 0) or 1
+    with pd.read_csv(uploaded_file, dtype=str, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield chunk, uploaded_file.tell() / size
+
+def iter_import_chunks(uploaded_file, chunksize=IMPORT_CHUNK_ROWS):
+    """逐塊讀取 CSV / Excel（.xlsx），產生 (DataFrame, 進度比例)，記憶體中只保留一塊"""
+    if uploaded_file.name.lower().endswith(".xlsx"):
+        return _iter_xlsx_chunks(uploaded_file, chunksize)
+    return _iter_csv_chunks(uploaded_file, chunksize)
+
+def import_products_streaming(uploaded_file, progress=None, chunksize=IMPORT_CHUNK_ROWS):
+    """串流匯入大型檔案：每塊讀取後即驗證、寫入並釋放，回傳與 import_products_bulk 相同格式的統計"""
+    start = time.perf_counter()
+    written = 0
+    error_count = 0
+    errors = []
+    for chunk, frac in iter_import_chunks(uploaded_file, chunksize):
+        report = import_products_bulk(chunk)
+        written += report["written"]
+        error_count += len(report["errors"])
+        errors.extend(report["errors"][:IMPORT_MAX_ERRORS - len(errors)])
+        if progress:
+            progress(min(frac, 1.0), written, error_count)
+    elapsed = time.perf_counter() - start
+    return {
+        "written": written,
+        "errors": errors,
+        "error_count": error_count,
+        "elapsed": elapsed,
+        "rate": written / elapsed if elapsed > 0 else 0.0
+    }
+
+ROLLUP_FIELDS = {"入庫": "inQty", "出庫": "outQty"}
+
+def rollup_doc_id(day, sku, location):
+    """彙總文件 ID：日期|SKU|地點（'/' 不可出現在文件 ID 中）"""
+    return "|".join([day, sku, location or "-"]).replace("/", "_")
+
+def _rollup_write(day, sku, location, op_type, qty, info=None):
+    """回傳 (彙總文件 ref, 以 merge=True 寫入的遞增欄位)"""
+    info = info or {}
+    fields = {
+        "date": day, "SKU": sku, "Location": location or "",
+        "count": firestore.Increment(1), "updatedAt": firestore.SERVER_TIMESTAMP
+    }
+    fields.update({k: v for k, v in info.items() if v})
+    if op_type in ROLLUP_FIELDS:
+        fields[ROLLUP_FIELDS[op_type]] = firestore.Increment(qty)
+    return db.collection(COLLECTION_rollups).document(rollup_doc_id(day, sku, location)), fields
+
+def _log_day(log):
+    ts = log.get("timestamp")
+    if isinstance(ts, datetime):
+        return str(ts.astimezone(timezone(timedelta(hours=8))).date())
+    return str(log.get("Time", ""))[:10] or None
 
-def save_log(entry):
-    entry["timestamp"] = firestore.SERVER_TIMESTAMP
-    db.collection(COLLECTION_logs).add(entry)
+def rebuild_rollups(progress=None):
+    """由完整異動紀錄重建彙總（分批讀取紀錄，只在記憶體中保留彙總結果），回傳彙總文件數
+
+    舊紀錄沒有 Location 時以目前型錄中的地點補上。重建期間的新異動可能被覆蓋，請於離峰時執行。
+    """
+    catalog = load_catalog()[0].set_index("SKU")
+    totals = {}
+    read = 0
+    for rows in iter_log_chunks(db, collection=COLLECTION_logs):
+        for log in rows:
+            sku, day = log.get("SKU"), _log_day(log)
+            if not sku or not day: continue
+            product = catalog.loc[sku] if sku in catalog.index else None
+            location = log.get("Location")
+            if location is None and product is not None: location = product["Location"]
+            key = rollup_doc_id(day, sku, location)
+            agg = totals.get(key)
+            if agg is None:
+                agg = totals[key] = {
+                    "date": day, "SKU": sku, "Location": location or "", "Name": log.get("Name", ""),
+                    "Category": product["Category"] if product is not None else "",
+                    "ItemType": product["ItemType"] if product is not None else "",
+                    "inQty": 0, "outQty": 0, "count": 0
+                }
+            if log.get("Type") in ROLLUP_FIELDS:
+                agg[ROLLUP_FIELDS[log["Type"]]] += _int_or_zero(log.get("Quantity"))
+            agg["count"] += 1
+        read += len(rows)
+        if progress: progress(read)
+
+    # 先清除舊彙總再整批寫入
+    batch, ops = db.batch(), 0
+    for doc in db.collection(COLLECTION_rollups).stream():
+        batch.delete(doc.reference)
+        ops += 1
+        if ops % IMPORT_BATCH_SIZE == 0:
+            batch.commit()
+            batch = db.batch()
+    for key, agg in totals.items():
+        agg["updatedAt"] = firestore.SERVER_TIMESTAMP
+        batch.set(db.collection(COLLECTION_rollups).document(key), agg)
+        ops += 1
+        if ops % IMPORT_BATCH_SIZE == 0:
+            batch.commit()
+            batch = db.batch()
+    if ops % IMPORT_BATCH_SIZE:
+        batch.commit()
+    query_rollups.clear()
+    return len(totals)
+
+def _int_or_zero(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+ROLLUP_COLUMNS = ["date", "SKU", "Name", "Category", "ItemType", "Location", "inQty", "outQty", "count"]
+
+@st.cache_data(ttl=60, max_entries=16)
+def query_rollups(start_day, end_day):
+    """讀取日期區間（含頭尾，YYYY-MM-DD 字串）內的彙總文件"""
+    docs = db.collection(COLLECTION_rollups).where("date", ">=", start_day).where("date", "<=", end_day).stream()
+    df = pd.DataFrame([doc.to_dict() for doc in docs])
+    for col in ROLLUP_COLUMNS:
+        if col not in df.columns: df[col] = 0 if col in ("inQty", "outQty", "count") else ""
+    df = df[ROLLUP_COLUMNS]
+    df[["inQty", "outQty", "count"]] = df[["inQty", "outQty", "count"]].fillna(0).astype("int64")
+    return df.fillna("")
+
+STOCK_TX_MAX_ATTEMPTS = 5  # 單次交易內 Firestore 自動重試次數
+STOCK_TX_MAX_ROUNDS = 3  # 交易重試耗盡後，外層退避重來的輪數
+STOCK_TX_BACKOFF = 0.1  # 外層退避基準秒數（指數成長）
+
+@st.cache_resource
+def _stock_tx_metrics():
+    """庫存交易統計（跨 session）"""
+    return {"lock": threading.Lock(), "commits": 0, "attempts": 0, "retries": 0, "backoffs": 0, "rejected": 0, "failures": 0}
+
+def _record_stock_tx(**counts):
+    metrics = _stock_tx_metrics()
+    with metrics["lock"]:
+        for key, n in counts.items():
+            metrics[key] += n
+
+def get_stock_tx_metrics():
+    metrics = _stock_tx_metrics()
+    with metrics["lock"]:
+        return {k: v for k, v in metrics.items() if k != "lock"}
+
+STOCK_TX_CHUNK = 150  # 每筆交易最多處理的 SKU 數（每個 SKU 三個寫入：庫存、紀錄、彙總，低於單一交易 500 個上限）
+
+def adjust_stock(sku, delta, op_type, note="", user="Admin"):
+    """以 Firestore 交易原子地調整庫存並寫入異動紀錄
+
+    兩者在同一個交易內提交，同時掃描同一 SKU 時由 Firestore 偵測衝突並重試，不會遺失更新。
+    回傳 (狀態, 值)：("ok", 新庫存)、("insufficient", 目前庫存)、("missing", None)、("error", 錯誤訊息)。
+    """
+    return adjust_stock_batch({sku: delta}, op_type, note=note, user=user)[sku]
+
+def adjust_stock_batch(deltas, op_type, note="", user="Admin"):
+    """在少數幾筆交易內套用多個 SKU 的庫存變動（SKU → 數量變化），每個 SKU 各寫一筆異動紀錄
+
+    庫存不足或不存在的 SKU 會被略過，其餘照常提交；回傳 SKU → (狀態, 值)，格式同 adjust_stock。
+    """
+    results = {}
+    skus = list(deltas)
+    for i in range(0, len(skus), STOCK_TX_CHUNK):
+        results.update(_adjust_stock_chunk({sku: deltas[sku] for sku in skus[i:i + STOCK_TX_CHUNK]}, op_type, note, user))
+
+    applied = {sku: {'stock': value} for sku, (status, value) in results.items() if status == "ok"}
+    if applied:
+        invalidate_products(applied)
+    return results
+
+def _adjust_stock_chunk(deltas, op_type, note, user):
+    refs = {sku: db.collection(COLLECTION_products).document(sku) for sku in deltas}
+    today = str(get_taiwan_date())
+    attempts = 0
+
+    @firestore.transactional
+    def _apply(transaction):
+        nonlocal attempts
+        attempts += 1
+        # 交易內必須先完成所有讀取才能寫入
+        snaps = {snap.id: snap for snap in transaction.get_all(list(refs.values()))}
+        out = {}
+        for sku, delta in deltas.items():
+            snap = snaps.get(sku)
+            if snap is None or not snap.exists:
+                out[sku] = ("missing", None)
+                continue
+            data = snap.to_dict()
+            current = data.get('stock', 0)
+            new_stock = current + delta
+            if new_stock < 0:
+                out[sku] = ("insufficient", current)
+                continue
+            transaction.update(refs[sku], {'stock': new_stock, 'updatedAt': firestore.SERVER_TIMESTAMP})
+            transaction.set(db.collection(COLLECTION_logs).document(), {
+                "Time": get_taiwan_time(),
+                "User": user,
+                "Type": op_type,
+                "SKU": sku,
+                "Name": data.get('name', ''),
+                "Location": data.get('location', ''),
+                "Quantity": abs(delta),
+                "Note": note,
+                "timestamp": firestore.SERVER_TIMESTAMP
+            })
+            transaction.set(*_rollup_write(
+                today, sku, data.get('location', ''), op_type, abs(delta),
+                {"Name": data.get('name', ''), "Category": data.get('categoryName', ''), "ItemType": data.get('itemType', '儀器')}
+            ), merge=True)
+            out[sku] = ("ok", new_stock)
+        return out
+
+    for round_no in range(STOCK_TX_MAX_ROUNDS):
+        attempts = 0
+        try:
+            out = _apply(db.transaction(max_attempts=STOCK_TX_MAX_ATTEMPTS))
+        except (ValueError, gcp_exceptions.Aborted) as e:
+            # 高度競爭時交易重試耗盡，退避後整筆重來
+            _record_stock_tx(attempts=attempts, retries=max(attempts - 1, 0))
+            if round_no == STOCK_TX_MAX_ROUNDS - 1:
+                _record_stock_tx(failures=len(deltas))
+                return {sku: ("error", str(e)) for sku in deltas}
+            _record_stock_tx(backoffs=1)
+            time.sleep(STOCK_TX_BACKOFF * (2 ** round_no))
+            continue
+        except (gcp_exceptions.GoogleAPICallError, gcp_exceptions.RetryError) as e:
+            # 服務無法使用、逾時等錯誤不重試，只讓這一批 SKU 失敗，其他批次照常提交
+            _record_stock_tx(attempts=attempts, failures=len(deltas))
+            return {sku: ("error", str(e)) for sku in deltas}
+        ok = sum(1 for status, _ in out.values() if status == "ok")
+        _record_stock_tx(attempts=attempts, retries=max(attempts - 1, 0), commits=ok, rejected=len(out) - ok)
+        return out
+
+def _tombstone(sku):
+    return db.collection(COLLECTION_tombstones).document(sku), {"deletedAt": firestore.SERVER_TIMESTAMP}
+
+def delete_product(sku):
+    """刪除產品並寫入刪除標記"""
+    batch = db.batch()
+    batch.delete(db.collection(COLLECTION_products).document(sku))
+    batch.set(*_tombstone(sku))
+    batch.commit()
+    invalidate_product(sku, deleted=True)
 
 def delete_all_products_logic():
     docs = db.collection(COLLECTION_products).stream()
@@ -451,106 +1119,283 @@ def delete_all_products_logic():
     batch = db.batch()
     for doc in docs:
         batch.delete(doc.reference)
+        batch.set(*_tombstone(doc.id))
         count += 1
-        if count % 400 == 0:
+        # 每筆產品 2 個寫入（刪除 + 刪除標記），維持每批 400 個操作
+        if count % 200 == 0:
             batch.commit()
             batch = db.batch()
-    if count > 0 and count % 400 != 0:
+    if count > 0 and count % 200 != 0:
         batch.commit()
-    st.cache_data.clear()
+    invalidate_catalog()
     return count
 
-def upload_image_to_firebase(uploaded_file, sku, bucket_override=None):
-    if uploaded_file is None: return None
-    
+@st.cache_resource
+def get_r2():
+    """跨 session 共用的 R2 client 與 (bucket, 公開網域)；未設定 cloudflare 時拋出例外且不快取"""
+    r2_conf = st.secrets["cloudflare"]
+    return r2_client_from_conf(r2_conf), r2_conf["bucket_name"], r2_conf["public_domain"]
+
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"  # 內容定址的物件永不改變
+
+IMAGE_CONTENT_TYPES = {"jpeg": ("jpg", "image/jpeg"), "webp": ("webp", "image/webp"), "avif": ("avif", "image/avif")}
+
+def product_image_key(data, fmt="jpeg"):
+    """以內容雜湊命名物件：相同圖片（即使屬於不同 SKU）只存一份，URL 可永久快取"""
+    return f"images/{hashlib.sha256(data).hexdigest()}.{IMAGE_CONTENT_TYPES[fmt][0]}"
+
+def _r2_object_exists(s3_client, bucket_name, key):
     try:
-        r2_conf = st.secrets["cloudflare"]
-        endpoint = r2_conf["endpoint"]
-        access_key = r2_conf["access_key"]
-        secret_key = r2_conf["secret_key"]
-        bucket_name = r2_conf["bucket_name"]
-        public_domain = r2_conf["public_domain"]
-        
-        image = Image.open(uploaded_file)
-        if image.mode in ("RGBA", "P"): image = image.convert("RGB")
-        max_width = 800
-        if image.width > max_width:
-            ratio = max_width / float(image.width)
-            new_height = int(float(image.height) * ratio)
-            image = image.resize((max_width, new_height), Image.Resampling.LANCZOS)
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='JPEG', quality=80)
-        img_byte_arr.seek(0)
-
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=endpoint,
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key
-        )
-        safe_sku = "".join([c for c in sku if c.isalnum() or c in ('-','_')])
-        file_name = f"images/{safe_sku}-{int(time.time())}.jpg"
-        
-        s3_client.upload_fileobj(
-            img_byte_arr,
-            bucket_name,
-            file_name,
-            ExtraArgs={'ContentType': 'image/jpeg'}
-        )
-        return f"{public_domain}/{file_name}"
-        
+        s3_client.head_object(Bucket=bucket_name, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+def _optional_r2():
+    try:
+        return get_r2()
+    except Exception:
+        return None
+
+def store_image_object(data, fmt="jpeg", r2=None, bucket_override=None):
+    """上傳已編碼的圖片並回傳公開 URL：優先 R2，失敗時改用 Firebase Storage
+
+    物件已存在（相同內容）時略過上傳，但以原地複製更新 LastModified，
+    讓 gc_images.py 的寬限期從這次重新使用起算，不會刪掉即將被參照的舊物件。
+    r2 為 get_r2() 的結果（None 表示未設定），由呼叫端先取得，以便在工作執行緒中呼叫。
+    """
+    key = product_image_key(data, fmt)
+    content_type = IMAGE_CONTENT_TYPES[fmt][1]
+    try:
+        if r2 is None: raise RuntimeError("未設定 Cloudflare R2")
+        s3_client, bucket_name, public_domain = r2
+        if not _r2_object_exists(s3_client, bucket_name, key):
+            s3_client.put_object(Bucket=bucket_name, Key=key, Body=data, ContentType=content_type,
+                                 CacheControl=IMAGE_CACHE_CONTROL)
+        else:
+            s3_client.copy_object(Bucket=bucket_name, Key=key, CopySource={"Bucket": bucket_name, "Key": key},
+                                  MetadataDirective="REPLACE", ContentType=content_type,
+                                  CacheControl=IMAGE_CACHE_CONTROL)
+        return f"{public_domain}/{key}"
     except Exception as e:
         try:
             target_bucket = bucket_override if bucket_override else bucket
-            safe_sku = "".join([c for c in sku if c.isalnum() or c in ('-','_')])
-            blob_name = f"images/{safe_sku}-{int(time.time())}.jpg"
-            blob = target_bucket.blob(blob_name)
-            blob.upload_from_file(uploaded_file, content_type=uploaded_file.type)
+            blob = target_bucket.blob(key)
+            if not blob.exists():
+                blob.cache_control = IMAGE_CACHE_CONTROL
+                blob.upload_from_string(data, content_type=content_type)
             blob.make_public()
             return blob.public_url
         except Exception as fb_e:
-            st.error(f"上傳失敗: {e} | {fb_e}")
-            return None
+            raise RuntimeError(f"{e} | {fb_e}")
+
+def store_product_images(renditions, r2=None, bucket_override=None):
+    """上傳 render_product_images 產生的所有版本，回傳 (imageFile URL, imageVariants)
 
-def check_warranty_status(warranty_end):
-    """檢查保固狀態（90 天提醒週期）"""
-    if pd.isna(warranty_end): return None, None
+    imageFile 沿用最大尺寸的 JPEG；imageVariants 為 {寬度: {格式: URL}}。
+    """
+    variants = {
+        width: {fmt: store_image_object(data, fmt, r2, bucket_override) for fmt, data in by_fmt.items()}
+        for width, by_fmt in renditions.items()
+    }
+    return variants[str(IMAGE_MAX_WIDTH)]["jpeg"], variants
+
+def upload_image_to_firebase(uploaded_file, sku, bucket_override=None):
+    """上傳單張圖片，回傳 (imageFile URL, imageVariants)，失敗時為 (None, {})"""
+    if uploaded_file is None: return None, {}
     try:
-        end_date = pd.to_datetime(warranty_end)
-        today = pd.Timestamp.now()
-        days_left = (end_date - today).days
-        if days_left < 0: return "已過期", days_left
-        elif days_left <= 90: return "即將到期", days_left  # 改為 90 天（一季）
-        else: return "正常", days_left
-    except: return None, None
-
-def get_warranty_alerts(df):
-    alerts = []
-    for idx, row in df.iterrows():
-        if pd.notna(row['WarrantyEnd']):
-            status, days = check_warranty_status(row['WarrantyEnd'])
-            if status in ["已過期", "即將到期"]:
-                alerts.append({
-                    'SKU': row['SKU'],
-                    'Name': row['Name'],
-                    'Category': row['Category'],
-                    'Location': row['Location'],
-                    'WarrantyEnd': row['WarrantyEnd'],
-                    'Status': status,
-                    'DaysLeft': days
-                })
-    return sorted(alerts, key=lambda x: x['DaysLeft'])
+        return store_product_images(render_product_images(uploaded_file), _optional_r2(), bucket_override)
+    except Exception as e:
+        st.error(f"上傳失敗: {e}")
+        return None, {}
+
+def _normalize_sku(text):
+    return text.replace(" ", "").replace("-", "").lower()
+
+class SkuMatcher:
+    """批次圖片上傳用的檔名 → SKU 比對器，每次上傳建立一次
+
+    依序嘗試：精確、正規化（忽略空格、連字號與大小寫）、部分（檔名為 SKU 的子字串）。
+    部分比對以 SKU 的字元二元組反向索引找出候選再確認；多個候選時取最短 SKU（同長度依字典序），
+    並回傳候選數供標示歧義。
+    """
+
+    def __init__(self, skus):
+        self._skus = set(skus)
+        self._normalized = {}  # 正規化 SKU → SKU 清單
+        self._postings = {}  # 二元組 → SKU 集合
+        self._chars = {}  # 單字元 → SKU 集合（供單字元檔名）
+        for sku in self._skus:
+            self._normalized.setdefault(_normalize_sku(sku), []).append(sku)
+            for i in range(len(sku) - 1):
+                self._postings.setdefault(sku[i:i + 2], set()).add(sku)
+            for ch in set(sku):
+                self._chars.setdefault(ch, set()).add(sku)
+
+    @staticmethod
+    def _pick(candidates):
+        return min(candidates, key=lambda sku: (len(sku), sku))
+
+    def match(self, filename):
+        """回傳 (SKU 或 None, 比對方式, 候選數)"""
+        if filename in self._skus:
+            return filename, "精確", 1
+        same = self._normalized.get(_normalize_sku(filename))
+        if same:
+            return self._pick(same), "模糊", len(same)
+        if not filename:
+            return None, None, 0
+        if len(filename) == 1:
+            candidates = self._chars.get(filename, set())
+        else:
+            # 由最小的 posting list 開始取交集
+            lists = sorted((self._postings.get(filename[i:i + 2], set()) for i in range(len(filename) - 1)), key=len)
+            candidates = lists[0].intersection(*lists[1:])
+            candidates = [sku for sku in candidates if filename in sku]
+        if not candidates:
+            return None, None, 0
+        return self._pick(candidates), "部分", len(candidates)
+
+IMAGE_PROCESS_WORKERS = min(4, os.cpu_count() or 1)
+IMAGE_UPLOAD_WORKERS = min(16, R2_MAX_POOL_CONNECTIONS)
+IMAGE_PROCESS_POOL_MIN = 8  # 檔案少於此數時以執行緒處理，省去子行程啟動成本
+
+def upload_images_batch(items, progress=None):
+    """批次上傳圖片並更新 imageFile / imageVariants
+
+    items 為 [(SKU, 原始圖片 bytes)]。Pillow 處理（含所有縮圖版本）在子行程平行進行，每張處理完立即
+    交給執行緒池上傳，全部完成後以 Firestore 批次一次寫入。progress(done, total) 於每張完成時呼叫。
+    回傳與 items 同順序的 [(SKU, URL 或 None, 錯誤訊息或 None)]。
+    """
+    r2 = _optional_r2()
+    results = [None] * len(items)
+    variants = [{}] * len(items)
+    total, done = len(items), 0
+    if len(items) >= IMAGE_PROCESS_POOL_MIN:
+        # spawn 避免 fork 複製 Streamlit / gRPC 的執行緒狀態
+        encoder = ProcessPoolExecutor(IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        encoder = ThreadPoolExecutor(IMAGE_PROCESS_WORKERS)
+    with encoder, ThreadPoolExecutor(IMAGE_UPLOAD_WORKERS) as uploader:
+        encoding = {encoder.submit(render_product_images, data): i for i, (_, data) in enumerate(items)}
+        uploading = {}
+        pending = set(encoding)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                if fut in encoding:
+                    i = encoding.pop(fut)
+                    try:
+                        renditions = fut.result()
+                    except Exception as e:
+                        results[i] = (items[i][0], None, f"圖片處理失敗: {e}")
+                    else:
+                        up = uploader.submit(store_product_images, renditions, r2)
+                        uploading[up] = i
+                        pending.add(up)
+                        continue
+                else:
+                    i = uploading.pop(fut)
+                    try:
+                        url, variants[i] = fut.result()
+                        results[i] = (items[i][0], url, None)
+                    except Exception as e:
+                        results[i] = (items[i][0], None, f"圖片上傳失敗: {e}")
+                done += 1
+                if progress: progress(done, total)
+
+    updates = {sku: {"imageFile": url, "imageVariants": v} for (sku, url, _), v in zip(results, variants) if url}
+    skus = list(updates)
+    try:
+        for start in range(0, len(skus), IMPORT_BATCH_SIZE):
+            batch = db.batch()
+            for sku in skus[start:start + IMPORT_BATCH_SIZE]:
+                batch.update(db.collection(COLLECTION_products).document(sku),
+                             dict(updates[sku], updatedAt=firestore.SERVER_TIMESTAMP))
+            batch.commit()
+    except Exception as e:
+        return [(sku, None, f"圖片已上傳但資料庫更新失敗: {e}") if url else (sku, url, err) for sku, url, err in results]
+    if updates:
+        invalidate_products(updates)
+    return results
+
+WARRANTY_WARN_DAYS = 90  # 預設提醒天數（一季）
+
+def get_taiwan_date():
+    return datetime.now(timezone(timedelta(hours=8))).date()
+
+def compute_warranty_status(warranty_end, today, warn_days=WARRANTY_WARN_DAYS):
+    """向量化計算整欄的剩餘天數與保固狀態，回傳 (DaysLeft, Status)，無保固日者為 NaN / None"""
+    end = pd.to_datetime(warranty_end, errors='coerce').to_numpy(dtype="datetime64[D]")
+    has_end = ~np.isnat(end)
+    days = np.where(has_end, (end - np.datetime64(today, "D")).astype("int64"), 0)
+    status = np.select([~has_end, days < 0, days <= warn_days], [None, "已過期", "即將到期"], "正常")
+    return pd.Series(np.where(has_end, days, np.nan), index=warranty_end.index), pd.Series(status, index=warranty_end.index)
+
+@st.cache_data(max_entries=16)
+def _warranty_alerts(version, today, warn_days, _df):
+    days, status = compute_warranty_status(_df["WarrantyEnd"], today, warn_days)
+    mask = status.isin(["已過期", "即將到期"]).to_numpy()
+    alerts = _df.loc[mask, ['SKU', 'Name', 'Category', 'Location', 'WarrantyEnd']].assign(
+        Status=status[mask], DaysLeft=days[mask].astype(int)
+    )
+    return alerts.sort_values('DaysLeft', kind="stable", ignore_index=True)
+
+def get_warranty_alerts(df, version, warn_days=WARRANTY_WARN_DAYS):
+    """保固提醒清單（DataFrame，依剩餘天數排序），以目錄版本與日期為快取鍵"""
+    return _warranty_alerts(version, get_taiwan_date(), warn_days, df)
+
+@st.cache_data(max_entries=4)
+def _catalog_stats(version, today, _df):
+    """統計分析用的彙總表，只在目錄版本或日期改變時重算"""
+    df = _df.assign(
+        Site=_df["Location"].fillna("").astype(str).str.split("-").str[0].replace("", "未填"),
+        Category=_df["Category"].fillna("").replace("", "未分類"),
+        Expiring=_df["WarrantyStatus"].eq("即將到期"),
+        Expired=_df["WarrantyStatus"].eq("已過期"),
+    )
+
+    def by(col):
+        return (df.groupby(col).agg(品項數=("SKU", "size"), 庫存量=("Stock", "sum"))
+                .sort_values("庫存量", ascending=False))
+
+    tiers = df["StockTier"].value_counts()
+    return {
+        "items": len(df),
+        "stock": int(df["Stock"].sum()),
+        "out_of_stock": int(tiers.get("無庫存", 0)),
+        "low_stock": int(tiers.get("低庫存", 0)),
+        "by_site": by("Site"),
+        "by_category": by("Category"),
+        "by_type": by("ItemType"),
+        "warranty": (df.groupby("Site")[["Expired", "Expiring"]].sum()
+                     .rename(columns={"Expired": "已過期", "Expiring": "即將到期"})
+                     .query("已過期 > 0 or 即將到期 > 0")),
+        "low_stock_items": (df.loc[df["StockTier"] != "", ["SKU", "Name", "Category", "Location", "Stock"]]
+                            .sort_values("Stock", kind="stable")),
+    }
+
+def get_catalog_stats(df, version):
+    return _catalog_stats(version, get_taiwan_date(), df)
 
 def parse_accessories(acc_str):
-    if not acc_str or acc_str == "":
+    if not isinstance(acc_str, str) or acc_str == "":
         return {}
     try:
-        return json.loads(acc_str)
+        acc = json.loads(acc_str)
     except:
         return {"備註": acc_str}
+    return acc if isinstance(acc, dict) else {"備註": acc_str}
 
-def format_accessories_display(acc_str, max_items=3):
-    acc_dict = parse_accessories(acc_str)
+def accessories_to_map(acc):
+    """配件一律以 {名稱: 數量} 的 map 儲存；相容舊版的 JSON 字串"""
+    if isinstance(acc, dict):
+        return acc
+    return parse_accessories(acc)
+
+def summarize_accessories(acc_dict, max_items=3):
     if not acc_dict:
         return ""
     
@@ -560,18 +1405,427 @@ def format_accessories_display(acc_str, max_items=3):
         result += f" 等 {len(acc_dict)} 項"
     return result
 
+# 預設配件名稱的排列順序（依分類）
+ACCESSORY_ORDER = [name for items in ACCESSORY_CATEGORIES.values() for name in items]
+
+@st.cache_data(max_entries=4)
+def _accessory_index(version, _df):
+    rows = [
+        (sku, name, qty, loc)
+        for sku, acc, loc in zip(_df["SKU"], _df["AccDict"], _df["Location"])
+        for name, qty in acc.items()
+    ]
+    table = pd.DataFrame(rows, columns=["SKU", "Accessory", "Qty", "Location"])
+    # 自由文字的配件（如「其他」）數量不是數字，以 1 件計
+    table["Qty"] = pd.to_numeric(table["Qty"], errors='coerce').fillna(1).astype(int)
+    table["Site"] = table["Location"].fillna("").astype(str).str.split("-").str[0].replace("", "未填")
+    by_name = {name: dict(zip(g["SKU"], g["Qty"])) for name, g in table.groupby("Accessory", sort=False)}
+    known = [name for name in ACCESSORY_ORDER if name in by_name]
+    others = sorted(name for name in by_name if name not in ACCESSORY_ORDER)
+    return {"by_name": by_name, "names": known + others, "table": table}
+
+def get_accessory_index(df, version):
+    """配件反向索引（以目錄版本快取）：names 為出現過的配件，by_name 為配件 → {SKU: 數量}，table 為展開後的明細"""
+    return _accessory_index(version, df)
+
+def skus_with_accessories(acc_index, names):
+    """同時帶有所有指定配件的 SKU"""
+    sets = [set(acc_index["by_name"].get(name, {})) for name in names]
+    return set.intersection(*sets) if sets else set()
+
+def accessory_totals(acc_index, names):
+    """指定配件在各地點的總數量（列：配件，欄：地點）"""
+    table = acc_index["table"]
+    table = table[table["Accessory"].isin(names)]
+    if table.empty:
+        return pd.DataFrame()
+    pivot = table.pivot_table(index="Accessory", columns="Site", values="Qty", aggfunc="sum", fill_value=0)
+    pivot["合計"] = pivot.sum(axis=1)
+    return pivot.reindex([name for name in names if name in pivot.index])
+
+# 模糊搜尋的索引欄位
+SEARCH_FIELDS = ["Name", "SKU", "SN", "Category", "Location", "Accessories"]
+SEARCH_TOP_K = 500  # 模糊搜尋最多顯示的結果數
+SEARCH_TYPO_MIN_LEN = 4  # 查詢字長度達此值才啟用拼錯字比對
+LATIN_TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9._\-]*")
+
+# 搜尋相關度分數
+SCORE_EXACT_SKU = 100
+SCORE_EXACT = 90
+SCORE_PREFIX = 70
+SCORE_TOKEN = 50
+SCORE_SUBSTRING = 30
+SCORE_TYPO = 10
+
+class SearchIndex:
+    """模糊搜尋用的字元二元組（bigram）反向索引，中日韓文字與英數字一律逐字切分
+
+    查詢時取各二元組的 posting list 交集，再以子字串比對確認，結果與逐列 contains 相同。
+    另外為名稱、SKU、S/N 中的英數型號建立詞彙表，供拼錯字時以編輯距離比對。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._texts = {}  # SKU → 正規化後的搜尋文字
+        self._keys = {}  # SKU → (SKU, 名稱, S/N)，皆為小寫，供排序評分
+        self._sku_tokens = {}  # SKU → 名稱、SKU、S/N 中的詞
+        self._postings = {}  # 二元組 → SKU 集合
+        self._chars = {}  # 單字元 → SKU 集合（供單字查詢）
+        self._tokens = {}  # 英數詞彙 → SKU 集合
+        self._token_grams = {}  # 二元組 → 英數詞彙集合（拼錯字候選篩選）
+
+    @staticmethod
+    def _texts_of(df):
+        text = df[SEARCH_FIELDS[0]].fillna("").astype(str)
+        for col in SEARCH_FIELDS[1:]:
+            # 以換行分隔欄位，避免二元組跨欄位
+            text = text + "\n" + df[col].fillna("").astype(str)
+        return dict(zip(df["SKU"], text.str.lower()))
+
+    @staticmethod
+    def _grams(text):
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    @staticmethod
+    def _latin_tokens(text):
+        return set(LATIN_TOKEN_RE.findall(text))
+
+    def _add(self, sku, text):
+        self._texts[sku] = text
+        # 搜尋文字的前三個欄位依序為 Name、SKU、SN
+        name, sku_l, sn = text.split("\n")[:3]
+        self._keys[sku] = (sku_l, name, sn)
+        latin = self._latin_tokens(" ".join(self._keys[sku]))
+        self._sku_tokens[sku] = latin | set(name.split())
+        for gram in self._grams(text):
+            self._postings.setdefault(gram, set()).add(sku)
+        for ch in set(text):
+            self._chars.setdefault(ch, set()).add(sku)
+        for token in latin:
+            if token not in self._tokens:
+                self._tokens[token] = set()
+                for gram in self._grams(token):
+                    self._token_grams.setdefault(gram, set()).add(token)
+            self._tokens[token].add(sku)
+
+    def _remove(self, sku):
+        text = self._texts.pop(sku)
+        keys = self._keys.pop(sku)
+        del self._sku_tokens[sku]
+        for gram in self._grams(text):
+            self._postings[gram].discard(sku)
+        for ch in set(text):
+            self._chars[ch].discard(sku)
+        for token in self._latin_tokens(" ".join(keys)):
+            self._tokens[token].discard(sku)
+            if not self._tokens[token]:
+                del self._tokens[token]
+                for gram in self._grams(token):
+                    self._token_grams[gram].discard(token)
+
+    def sync(self, df, version):
+        """依目錄版本增量更新：只重新索引新增、刪除或內容變動的 SKU"""
+        with self._lock:
+            if version == self._version:
+                return
+            texts = self._texts_of(df)
+            for sku in [sku for sku, text in self._texts.items() if texts.get(sku) != text]:
+                self._remove(sku)
+            for sku, text in texts.items():
+                if sku not in self._texts:
+                    self._add(sku, text)
+            self._version = version
+
+    def _substring_hits(self, q):
+        if len(q) == 1:
+            return set(self._chars.get(q, ()))
+        postings = sorted((self._postings.get(gram, set()) for gram in self._grams(q)), key=len)
+        if not postings[0]:
+            return set()
+        hits = set(postings[0])
+        for posting in postings[1:]:
+            hits &= posting
+            if not hits:
+                return hits
+        return {sku for sku in hits if q in self._texts[sku]}
+
+    def search(self, term):
+        """回傳搜尋文字包含 term（不分大小寫）的 SKU 集合"""
+        q = str(term).lower()
+        if not q:
+            return set()
+        with self._lock:
+            return self._substring_hits(q)
+
+    def _score(self, sku, q):
+        sku_l, name, sn = self._keys[sku]
+        if sku_l == q:
+            return SCORE_EXACT_SKU
+        if q in (name, sn):
+            return SCORE_EXACT
+        if sku_l.startswith(q) or name.startswith(q) or sn.startswith(q):
+            return SCORE_PREFIX
+        if q in self._sku_tokens[sku]:
+            return SCORE_TOKEN
+        return SCORE_SUBSTRING
+
+    def _typo_hits(self, q):
+        """以編輯距離找出拼錯的英數型號，回傳 SKU → 距離"""
+        max_dist = 1 if len(q) < 8 else 2
+        grams = self._grams(q)
+        # q-gram 篩選：一次編輯最多破壞 3 個二元組（詞中間的相鄰對調，例如 abcd → acbd），
+        # 編輯距離 d 的詞至少要共有 need 個二元組，因此必定出現在最稀有的 len(grams) - need + 1
+        # 個二元組之一（鴿籠原理），只需從這些清單找候選
+        need = max(len(grams) - 3 * max_dist, 1)
+        rare = sorted(grams, key=lambda gram: len(self._token_grams.get(gram, ())))[:len(grams) - need + 1]
+        candidates = set()
+        for gram in rare:
+            candidates.update(self._token_grams.get(gram, ()))
+        q_chars = Counter(q).items()
+        out = {}
+        for token in candidates:
+            if abs(len(token) - len(q)) > max_dist:
+                continue
+            # 字元多重集合篩選（比二元組便宜，先做）：取代、插入、刪除各只造成一個缺少或多出的字元，
+            # 對調則不影響；多出的字元數 = 缺少的字元數 + 長度差
+            missing = sum(max(n - token.count(ch), 0) for ch, n in q_chars)
+            if max(missing, missing + len(token) - len(q)) > max_dist:
+                continue
+            if len(grams & self._grams(token)) < need:
+                continue
+            dist = _edit_distance(q, token, max_dist)
+            if dist <= max_dist:
+                for sku in self._tokens[token]:
+                    out[sku] = min(dist, out.get(sku, dist))
+        return out
+
+    def rank(self, term, allowed=None, k=SEARCH_TOP_K):
+        """依相關度回傳 (前 k 名 SKU, 總符合數)：完全符合 SKU > 完全符合名稱/序號 > 前綴 > 詞 > 子字串 > 拼錯字
+
+        allowed 為其他篩選條件保留下來的 SKU；以 heap 取前 k 名，不對全部結果排序。
+        """
+        q = str(term).lower().strip()
+        if not q:
+            return [], 0
+        with self._lock:
+            scores = {}
+            for sku in self._substring_hits(q):
+                if allowed is None or sku in allowed:
+                    scores[sku] = self._score(sku, q)
+            if len(q) >= SEARCH_TYPO_MIN_LEN and LATIN_TOKEN_RE.fullmatch(q):
+                for sku, dist in self._typo_hits(q).items():
+                    if sku not in scores and (allowed is None or sku in allowed):
+                        scores[sku] = SCORE_TYPO - dist
+        top = heapq.nsmallest(k, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [sku for sku, _ in top], len(scores)
+
+def _edit_distance(a, b, max_dist):
+    """編輯距離（相鄰字元對調算一次），只計算寬度 max_dist 的對角帶，超過時回傳 max_dist + 1"""
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    big = max_dist + 1
+    prev2, prev = None, [j if j <= max_dist else big for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        lo, hi = max(1, i - max_dist), min(len(b), i + max_dist)
+        cur = [big] * (len(b) + 1)
+        if i <= max_dist:
+            cur[0] = i
+        ca = a[i - 1]
+        for j in range(lo, hi + 1):
+            cb = b[j - 1]
+            d = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                d = min(d, prev2[j - 2] + 1)
+            cur[j] = d
+        if min(cur[lo - 1:hi + 1]) > max_dist:
+            return big
+        prev2, prev = prev, cur
+    return min(prev[-1], big)
+
+@st.cache_resource
+def get_search_index():
+    return SearchIndex()
+
+def search_catalog(df, term, version, allowed=None, k=SEARCH_TOP_K):
+    """以反向索引做模糊搜尋，回傳 (依相關度排序的前 k 名 SKU, 總符合數)"""
+    index = get_search_index()
+    index.sync(df, version)
+    return index.rank(term, allowed=allowed, k=k)
+
 # R2 公開網域
 R2_PUBLIC_DOMAIN = "https://pub-12069eb186dd414482e689701534d8d5.r2.dev"
 
-# 處理圖片 URL（支援多種格式）
-@st.cache_data(ttl=3600)  # 快取 1 小時
+IMAGE_URL_TTL = 3600  # 圖片 URL 快取 1 小時
+SIGNED_URL_LIFETIME = timedelta(hours=1)  # Firebase 簽名 URL 效期
+SIGNED_URL_REFRESH_MARGIN = 600  # 到期前 10 分鐘內被使用時於背景重新簽署
+SIGNED_URL_WORKERS = 8
+
+def is_firebase_storage_url(img_url):
+    return "storage.googleapis.com" in img_url or "firebasestorage.app" in img_url
+
+def _sign_firebase_url(img_url):
+    """為 Firebase Storage 物件產生 v4 簽名 URL，回傳 (簽名 URL, 到期時間戳)"""
+    import urllib.parse
+    parsed = urllib.parse.urlparse(img_url)
+    path_parts = parsed.path.split('/', 2)  # ['', 'bucket-name', 'path/to/file']
+    if len(path_parts) < 3:
+        raise ValueError(f"無法解析 Firebase Storage 路徑: {img_url}")
+    blob_path = urllib.parse.unquote(path_parts[2])  # 解碼 URL 編碼的中文
+    expires_at = time.time() + SIGNED_URL_LIFETIME.total_seconds()
+    signed_url = bucket.blob(blob_path).generate_signed_url(
+        version="v4",
+        expiration=SIGNED_URL_LIFETIME,
+        method="GET"
+    )
+    return signed_url, expires_at
+
+class SignedUrlCache:
+    """Firebase Storage 簽名 URL 的全域快取
+
+    依實際到期時間保存；一整頁的 URL 以執行緒池一次簽署，快到期且仍在使用的 URL 於背景重新簽署，
+    因此渲染頁面時不會逐張等待簽署。簽名 URL 只取決於物件路徑，不隨目錄失效而清除。
+    sign 為 原始 URL → (簽名 URL, 到期時間戳)，測試時可替換。
+    """
+
+    def __init__(self, sign, workers=SIGNED_URL_WORKERS, margin=SIGNED_URL_REFRESH_MARGIN):
+        self._sign = sign
+        self._margin = margin
+        self._lock = threading.Lock()
+        self._entries = {}  # 原始 URL → (簽名 URL, 到期時間戳)
+        self._refreshing = set()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="sign-url")
+
+    def _store(self, img_url, future):
+        try:
+            entry = future.result()
+        except Exception:
+            return None
+        with self._lock:
+            self._entries[img_url] = entry
+        return entry[0]
+
+    def _refresh(self, img_url):
+        # 已在工作執行緒中，直接簽署（再提交到同一個執行緒池可能互相等待）
+        try:
+            entry = self._sign(img_url)
+            with self._lock:
+                self._entries[img_url] = entry
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(img_url)
+
+    def resolve_many(self, img_urls):
+        """回傳 原始 URL → 簽名 URL（簽署失敗者不列入）；未快取或已過期的 URL 平行簽署並等待"""
+        now = time.time()
+        out, missing = {}, []
+        with self._lock:
+            for img_url in dict.fromkeys(img_urls):
+                entry = self._entries.get(img_url)
+                if entry is None or entry[1] <= now:
+                    missing.append(img_url)
+                    continue
+                out[img_url] = entry[0]
+                if entry[1] - now < self._margin and img_url not in self._refreshing:
+                    self._refreshing.add(img_url)
+                    self._pool.submit(self._refresh, img_url)
+            # 順便清除已過期且未再使用的項目
+            for img_url in [u for u, (_, exp) in self._entries.items() if exp <= now]:
+                del self._entries[img_url]
+        futures = {img_url: self._pool.submit(self._sign, img_url) for img_url in missing}
+        for img_url, future in futures.items():
+            signed = self._store(img_url, future)
+            if signed:
+                out[img_url] = signed
+        return out
+
+    def get(self, img_url):
+        return self.resolve_many([img_url]).get(img_url)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "refreshing": len(self._refreshing)}
+
+@st.cache_resource
+def get_signed_url_cache():
+    return SignedUrlCache(_sign_firebase_url)
+
+def prefetch_image_urls(img_urls):
+    """渲染一頁結果前先一次簽署頁面上所有 Firebase 圖片"""
+    legacy = [str(u).strip() for u in img_urls if u and is_firebase_storage_url(str(u))]
+    if legacy:
+        get_signed_url_cache().resolve_many(legacy)
+
+@st.cache_resource
+def _image_url_cache():
+    """以原始圖片 URL 為鍵的全域快取，可單獨失效個別項目"""
+    return {"lock": threading.Lock(), "entries": {}}
+
+def invalidate_image_url(*img_urls):
+    cache = _image_url_cache()
+    with cache["lock"]:
+        for img_url in img_urls:
+            if img_url:
+                cache["entries"].pop(str(img_url).strip(), None)
+
 def get_displayable_image_url(img_url):
+    """取得可顯示的圖片 URL（快取 1 小時；Firebase 簽名 URL 依實際到期時間另行快取）"""
+    if not img_url:
+        return None
+    key = str(img_url).strip()
+    if is_firebase_storage_url(key):
+        # 簽署失敗時回傳原始 URL
+        return get_signed_url_cache().get(key) or key
+    cache = _image_url_cache()
+    now = time.time()
+    with cache["lock"]:
+        hit = cache["entries"].get(key)
+    if hit and hit[1] > now:
+        return hit[0]
+    url = _resolve_image_url(key)
+    with cache["lock"]:
+        cache["entries"][key] = (url, now + IMAGE_URL_TTL)
+    return url
+
+# 圖片代理（選用）：由伺服器下載圖片並存在磁碟 LRU 快取，st.image 直接收到 bytes，
+# 各據點不必再各自連到 R2，簽名 URL 每小時變動也不影響快取
+IMAGE_PROXY = bool(get_secret("images", "proxy", False))
+IMAGE_PROXY_DIR = get_secret("images", "cache_dir", os.path.join(tempfile.gettempdir(), "inventory_image_cache"))
+IMAGE_PROXY_MAX_MB = get_secret("images", "cache_max_mb", 512)
+IMAGE_PROXY_TIMEOUT = 10
+
+@st.cache_resource
+def get_image_proxy():
+    return DiskImageCache(IMAGE_PROXY_DIR, int(IMAGE_PROXY_MAX_MB) * 1024 * 1024)
+
+def get_image_source(img_url):
+    """st.image 的來源：代理模式回傳磁碟快取中的圖片 bytes，否則（或下載失敗時）回傳可顯示的 URL
+
+    以資料庫中的原始 URL 為快取鍵；圖片物件以內容雜湊命名、不會被覆寫，因此快取不需失效。
+    """
+    url = get_displayable_image_url(img_url)
+    if not IMAGE_PROXY or not url or url.startswith("data:"):
+        return url
+
+    def fetch():
+        resp = requests.get(url, timeout=IMAGE_PROXY_TIMEOUT)
+        resp.raise_for_status()
+        return resp.content
+
+    try:
+        return get_image_proxy().get(str(img_url).strip(), fetch)
+    except Exception:
+        return url
+
+def _resolve_image_url(img_url):
     """
     處理圖片 URL，支援以下格式：
     1. 相對路徑 (images/xxx.jpg) → 加上 R2 public domain
     2. 完整 R2 URL → 直接返回
-    3. Firebase Storage URL → 產生簽名 URL
-    4. 其他完整 URL → 直接返回
+    3. 其他完整 URL → 直接返回
+    Firebase Storage URL 由 get_displayable_image_url 交給 SignedUrlCache 簽署，不會進到這裡。
     """
     if not img_url:
         return None
@@ -593,27 +1847,7 @@ def get_displayable_image_url(img_url):
     if img_url.startswith("data:"):
         return img_url
     
-    # 情況 3: Firebase Storage URL → 產生簽名 URL
-    if "storage.googleapis.com" in img_url or "firebasestorage.app" in img_url:
-        try:
-            import urllib.parse
-            parsed = urllib.parse.urlparse(img_url)
-            path_parts = parsed.path.split('/', 2)  # ['', 'bucket-name', 'path/to/file']
-            if len(path_parts) >= 3:
-                blob_path = urllib.parse.unquote(path_parts[2])  # 解碼 URL 編碼的中文
-                blob = bucket.blob(blob_path)
-                # 產生 1 小時有效的簽名 URL
-                signed_url = blob.generate_signed_url(
-                    version="v4",
-                    expiration=timedelta(hours=1),
-                    method="GET"
-                )
-                return signed_url
-        except Exception as e:
-            # 如果產生簽名 URL 失敗，返回原始 URL
-            pass
-    
-    # 情況 4: Cloudflare R2 完整 URL 或其他 URL → 直接返回
+    # 情況 3: Cloudflare R2 完整 URL 或其他 URL → 直接返回
     return img_url
 
 # --- 5. 主程式介面 ---
@@ -623,12 +1857,13 @@ def main():
     <div class='sidebar-brand'>WebInventory</div>
     """, unsafe_allow_html=True)
     
-    df = load_data()
-    warranty_alerts = get_warranty_alerts(df)
+    df, catalog_version = load_catalog()
+    warn_days = st.session_state.get("warranty_warn_days", WARRANTY_WARN_DAYS)
+    warranty_alerts = get_warranty_alerts(df, catalog_version, warn_days)
     
-    if warranty_alerts:
+    if not warranty_alerts.empty:
         with st.sidebar.expander(f"保固提醒 ({len(warranty_alerts)})", expanded=True):
-            for alert in warranty_alerts[:5]:
+            for alert in warranty_alerts.head(5).to_dict("records"):
                 days = alert['DaysLeft']
                 day_text = f"過期 {abs(days)} 天" if days < 0 else f"剩餘 {days} 天"
                 st.markdown(f"""
@@ -642,7 +1877,8 @@ def main():
         "總覽", 
         "資料維護",
         "異動紀錄",
-        "保固管理"
+        "保固管理",
+        "統計分析"
     ]
     
     page = st.sidebar.radio("", menu_options, label_visibility="collapsed")
@@ -651,33 +1887,46 @@ def main():
     elif page == "資料維護": page_maintenance()
     elif page == "異動紀錄": page_reports()
     elif page == "保固管理": page_warranty_management()
+    elif page == "統計分析": page_analytics()
+
+STOCK_TIER_CLASSES = {"無庫存": "tag-danger", "低庫存": "tag-warning"}
+
+def render_tags_html(row):
+    """由載入時物化的庫存等級與保固狀態組出標籤"""
+    tags = [f'<span class="tag tag-type">{row["ItemType"]}</span>']
+    if row['StockTier']:
+        tags.append(f'<span class="tag {STOCK_TIER_CLASSES[row["StockTier"]]}">{row["StockTier"]}</span>')
+    if row['WarrantyStatus'] == "已過期":
+        tags.append('<span class="tag tag-danger">過保</span>')
+    return " ".join(tags)
+
+IMAGE_DISPLAY_FORMATS = ("webp", "jpeg")  # 顯示時的格式偏好
+THUMB_WIDTH = 64
+DETAIL_IMAGE_WIDTH = 300
+
+def pick_image_url(row, width):
+    """依顯示寬度挑選足夠大的最小版本（資料庫中的原始 URL）；沒有縮圖、或縮圖不屬於目前的 imageFile 時使用原圖"""
+    raw_img_url = row.get('ImageFile', '')
+    variants = row.get('ImageVariants')
+    if isinstance(variants, dict) and variants.get(str(IMAGE_MAX_WIDTH), {}).get("jpeg") == raw_img_url:
+        widths = sorted(int(w) for w in variants)
+        chosen = variants[str(next((w for w in widths if w >= width), widths[-1]))]
+        for fmt in IMAGE_DISPLAY_FORMATS:
+            if chosen.get(fmt):
+                return chosen[fmt]
+    return raw_img_url
+
+def pick_image_source(row, width):
+    return get_image_source(pick_image_url(row, width))
 
 def render_item_card(row):
     """渲染項目卡片 - 使用 Streamlit 原生元件"""
-    raw_img_url = row.get('ImageFile', '')
-    img_url = get_displayable_image_url(raw_img_url)
+    img_url = pick_image_source(row, THUMB_WIDTH)
     item_type = row.get('ItemType', '儀器')
     
-    try: stock = int(row['Stock'])
-    except: stock = 0
-    
-    # 標籤
-    tags = []
-    tags.append(f'<span class="tag tag-type">{item_type}</span>')
-    if stock == 0:
-        tags.append('<span class="tag tag-danger">無庫存</span>')
-    elif stock <= 5:
-        tags.append('<span class="tag tag-warning">低庫存</span>')
-        
-    warranty_status, _ = check_warranty_status(row.get('WarrantyEnd'))
-    if warranty_status == "已過期":
-        tags.append('<span class="tag tag-danger">過保</span>')
-
-    tags_html = " ".join(tags)
-
-    # 配件
-    acc_str = row.get('Accessories', '')
-    acc_display = format_accessories_display(acc_str)
+    stock = row['Stock']
+    tags_html = render_tags_html(row)
+    acc_display = row['AccSummary']
 
     # 使用 Streamlit 原生元件佈局
     with st.container():
@@ -737,9 +1986,9 @@ def show_product_detail(row):
     """, unsafe_allow_html=True)
     
     # 圖片顯示（限制寬度以適應手機）
-    img_url = get_displayable_image_url(row.get('ImageFile', ''))
+    img_url = pick_image_source(row, DETAIL_IMAGE_WIDTH)
     if img_url:
-        st.image(img_url, width=300)
+        st.image(img_url, width=DETAIL_IMAGE_WIDTH)
     else:
         st.caption("📷 無產品圖片")
     
@@ -759,51 +2008,30 @@ def show_product_detail(row):
     
     with col2:
         st.markdown(f"**庫存** {row.get('Stock', 0)}")
-        if row.get('WarrantyStart'):
+        # 日期欄位為 datetime，缺值是 NaT（布林值為 True），需用 pd.notna 判斷
+        if pd.notna(row.get('WarrantyStart')):
             st.markdown(f"**保固起** {row['WarrantyStart']}")
-        if row.get('WarrantyEnd'):
-            warranty_status, days_left = check_warranty_status(row['WarrantyEnd'])
-            if warranty_status:
+        if pd.notna(row.get('WarrantyEnd')):
+            warranty_status = row.get('WarrantyStatus')
+            if pd.notna(warranty_status) and warranty_status:
                 status_color = "🟢" if warranty_status == "正常" else "🟡" if warranty_status == "即將到期" else "🔴"
                 st.markdown(f"**保固迄** {row['WarrantyEnd']} {status_color}")
     
     # 配件資訊
-    if row.get('Accessories'):
+    if row.get('AccDict'):
         st.markdown("")
         st.markdown("**📦 配件**")
-        try:
-            acc_dict = json.loads(row['Accessories'])
-            acc_list = [f"{name} x{qty}" for name, qty in acc_dict.items()]
-            st.caption(" · ".join(acc_list))
-        except:
-            st.caption(row['Accessories'])
+        acc_list = [f"{name} x{qty}" for name, qty in row['AccDict'].items()]
+        st.caption(" · ".join(acc_list))
 
 def render_product_card_with_detail(row):
     """渲染產品卡片（帶詳情按鈕）"""
-    raw_img_url = row.get('ImageFile', '')
-    img_url = get_displayable_image_url(raw_img_url)
+    img_url = pick_image_source(row, THUMB_WIDTH)
     item_type = row.get('ItemType', '儀器')
     
-    try: stock = int(row['Stock'])
-    except: stock = 0
-    
-    # 標籤
-    tags = []
-    tags.append(f'<span class="tag tag-type">{item_type}</span>')
-    if stock == 0:
-        tags.append('<span class="tag tag-danger">無庫存</span>')
-    elif stock <= 5:
-        tags.append('<span class="tag tag-warning">低庫存</span>')
-        
-    warranty_status, _ = check_warranty_status(row.get('WarrantyEnd'))
-    if warranty_status == "已過期":
-        tags.append('<span class="tag tag-danger">過保</span>')
-
-    tags_html = " ".join(tags)
-
-    # 配件
-    acc_str = row.get('Accessories', '')
-    acc_display = format_accessories_display(acc_str)
+    stock = row['Stock']
+    tags_html = render_tags_html(row)
+    acc_display = row['AccSummary']
 
     # 使用 Streamlit 原生元件佈局
     with st.container():
@@ -844,6 +2072,36 @@ def render_product_card_with_detail(row):
         
         st.markdown('<hr style="margin: 8px 0; border: none; border-top: 1px solid #E8ECEB;">', unsafe_allow_html=True)
 
+SEARCH_PAGE_SIZES = [10, 20, 50]
+
+def render_result_page(result, query_key):
+    """分頁顯示搜尋結果，每次只建立目前頁面的卡片"""
+    # 查詢條件改變時回到第一頁
+    if st.session_state.get("search_query_key") != query_key:
+        st.session_state.search_query_key = query_key
+        st.session_state.search_page = 1
+
+    page_size = st.session_state.get("search_page_size", SEARCH_PAGE_SIZES[0])
+    pages = max(1, -(-len(result) // page_size))
+    st.session_state.search_page = min(max(st.session_state.get("search_page", 1), 1), pages)
+    start = (st.session_state.search_page - 1) * page_size
+    end = min(start + page_size, len(result))
+
+    page_rows = result.iloc[start:end]
+    prefetch_image_urls([pick_image_url(row, THUMB_WIDTH) for _, row in page_rows.iterrows()])
+    for _, row in page_rows.iterrows():
+        render_product_card_with_detail(row)
+
+    def go(delta):
+        st.session_state.search_page += delta
+
+    nc1, nc2, nc3, nc4, nc5 = st.columns([1, 1, 2, 1, 1])
+    nc1.button("← 上一頁", on_click=go, args=(-1,), disabled=st.session_state.search_page <= 1, use_container_width=True)
+    nc2.number_input("頁碼", min_value=1, max_value=pages, key="search_page", label_visibility="collapsed")
+    nc3.caption(f"第 {start + 1}–{end} 筆，共 {len(result)} 筆 · {pages} 頁")
+    nc4.selectbox("每頁筆數", SEARCH_PAGE_SIZES, key="search_page_size", label_visibility="collapsed")
+    nc5.button("下一頁 →", on_click=go, args=(1,), disabled=st.session_state.search_page >= pages, use_container_width=True)
+
 def page_search():
     """總覽頁面 - 首頁風格（莫蘭迪）"""
     
@@ -855,7 +2113,7 @@ def page_search():
     </div>
     """, unsafe_allow_html=True)
     
-    df = load_data()
+    df, catalog_version = load_catalog()
     
     # 2. 搜尋區（簡化、優雅）
     st.markdown("")
@@ -872,6 +2130,8 @@ def page_search():
         )
     
     # 3. 篩選條件（摺疊，柔和色調）
+    acc_index = get_accessory_index(df, catalog_version)
+
     with st.expander("🎛 進階篩選", expanded=False):
         fc1, fc2, fc3, fc4 = st.columns(4)
         
@@ -887,9 +2147,19 @@ def page_search():
         
         # S/N 搜尋
         filter_sn = fc4.text_input("S/N 序號", placeholder="輸入序號...")
+        
+        # 配件：帶有所有選取配件的儀器
+        filter_acc = st.multiselect("配件", options=acc_index["names"])
+    
+    with st.expander("📦 配件統計", expanded=False):
+        stat_acc = st.multiselect("選擇配件", options=acc_index["names"], key="acc_stat_select")
+        if stat_acc:
+            st.dataframe(accessory_totals(acc_index, stat_acc), use_container_width=True)
+        else:
+            st.caption("選擇配件以查看各地點的總數量")
     
     # 4. 判斷是否有搜尋條件
-    has_search = search_term or filter_type or filter_category or filter_location or filter_sn
+    has_search = search_term or filter_type or filter_category or filter_location or filter_sn or filter_acc
     
     if has_search:
         # 套用篩選條件
@@ -922,7 +2192,12 @@ def page_search():
         if filter_sn:
             result = result[result['SN'].astype(str).str.contains(filter_sn, case=False, na=False)]
         
+        # 配件篩選（查配件索引，不逐筆解析）
+        if filter_acc:
+            result = result[result['SKU'].isin(skus_with_accessories(acc_index, filter_acc))]
+        
         # 關鍵字搜尋
+        total = len(result)
         if search_term:
             if search_mode == "精確搜尋":
                 # 精確搜尋：完全匹配
@@ -931,78 +2206,182 @@ def page_search():
                     (result['SKU'].astype(str) == search_term) |
                     (result['SN'].astype(str) == search_term)
                 )
+                result = result[mask]
+                total = len(result)
             else:
-                # 模糊搜尋：包含關鍵字
-                mask = result.astype(str).apply(lambda x: x.str.contains(search_term, case=False, na=False)).any(axis=1)
-            
-            result = result[mask]
+                # 模糊搜尋：以反向索引找出符合的 SKU，依相關度排序（含拼錯字容錯）
+                ranked, total = search_catalog(df, search_term, catalog_version, allowed=set(result['SKU']))
+                result = result.set_index('SKU', drop=False).loc[ranked].reset_index(drop=True)
         
         # 顯示搜尋結果
-        st.markdown(f"### 搜尋結果（{len(result)} 筆）")
+        st.markdown(f"### 搜尋結果（{total} 筆）")
+        if total > len(result):
+            st.caption(f"依相關度顯示前 {len(result)} 筆，請輸入更精確的關鍵字")
         
         if len(result) == 0:
             st.warning("😕 找不到符合條件的產品")
         else:
-            for index, row in result.iterrows():
-                render_product_card_with_detail(row)
+            query_key = (search_mode, search_term, tuple(filter_type), tuple(filter_category), tuple(filter_location), filter_sn, tuple(filter_acc))
+            render_result_page(result, query_key)
     else:
         # 無搜尋時顯示提示
         st.info("👆 請輸入關鍵字或使用進階篩選來搜尋產品")
 
 def page_warranty_management():
     st.markdown("### 保固管理")
-    df = load_data()
-    alerts = get_warranty_alerts(df)
+    df, catalog_version = load_catalog()
+    # 元件的 key 在其他頁面不會繪製時會被 Streamlit 刪除，設定另存於 warranty_warn_days 供側邊欄使用
+    def save_warn_days():
+        st.session_state.warranty_warn_days = st.session_state.warranty_warn_days_input
+
+    warn_days = st.number_input(
+        "到期前幾天開始提醒", min_value=1, max_value=730, step=30,
+        value=st.session_state.get("warranty_warn_days", WARRANTY_WARN_DAYS),
+        key="warranty_warn_days_input", on_change=save_warn_days
+    )
+    alerts = get_warranty_alerts(df, catalog_version, warn_days)
     
-    if not alerts:
+    if alerts.empty:
         st.success("目前沒有保固到期的設備")
         return
 
-    st.dataframe(pd.DataFrame(alerts), use_container_width=True)
+    c1, c2 = st.columns(2)
+    c1.metric("已過期", int((alerts['Status'] == "已過期").sum()))
+    c2.metric(f"{warn_days} 天內到期", int((alerts['Status'] == "即將到期").sum()))
+    st.dataframe(alerts, use_container_width=True)
+
+ANALYTICS_TOP_CATEGORIES = 15
+
+def page_analytics():
+    st.markdown("### 統計分析")
+    df, catalog_version = load_catalog()
+    if df.empty:
+        st.info("目前沒有資料")
+        return
+    stats = get_catalog_stats(df, catalog_version)
+
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("品項數", stats["items"])
+    m2.metric("總庫存", stats["stock"])
+    m3.metric("無庫存", stats["out_of_stock"])
+    m4.metric(f"低庫存（≤{LOW_STOCK_THRESHOLD}）", stats["low_stock"])
+
+    c1, c2 = st.columns(2)
+    with c1:
+        st.markdown("##### 各據點庫存")
+        st.bar_chart(stats["by_site"]["庫存量"])
+    with c2:
+        st.markdown("##### 各類型庫存")
+        st.bar_chart(stats["by_type"]["庫存量"])
+
+    st.markdown(f"##### 分類庫存（前 {ANALYTICS_TOP_CATEGORIES} 名）")
+    st.bar_chart(stats["by_category"]["庫存量"].head(ANALYTICS_TOP_CATEGORIES), horizontal=True)
+
+    st.markdown("##### 保固風險（依據點）")
+    if stats["warranty"].empty:
+        st.caption("沒有已過期或即將到期的設備")
+    else:
+        st.bar_chart(stats["warranty"], stack=True)
+
+    with st.expander(f"⚠️ 低庫存清單（{len(stats['low_stock_items'])}）"):
+        st.dataframe(stats["low_stock_items"], use_container_width=True, hide_index=True)
+    with st.expander("📋 明細表"):
+        t1, t2, t3 = st.tabs(["據點", "分類", "類型"])
+        t1.dataframe(stats["by_site"], use_container_width=True)
+        t2.dataframe(stats["by_category"], use_container_width=True)
+        t3.dataframe(stats["by_type"], use_container_width=True)
+
+SCAN_FLUSH_INTERVAL = 10  # 連續掃描模式自動提交間隔（秒）
+SCAN_HISTORY_LIMIT = 200
 
 def page_operation(op_type):
     st.markdown(f"### {op_type}作業")
     
     col1, col2 = st.columns([1, 3])
     qty = col1.number_input("數量", min_value=1, value=1)
+    def on_burst_change():
+        # 關閉連續掃描時先提交暫存的掃描
+        if not st.session_state[f"burst_{op_type}"] and st.session_state.get(f"scan_queue_{op_type}"):
+            flush_scan_queue(op_type)
+
+    burst = col2.toggle("連續掃描模式（暫存後批次提交）", key=f"burst_{op_type}", on_change=on_burst_change)
     
     if "scan_input" not in st.session_state: 
         st.session_state.scan_input = ""
+    st.session_state.setdefault(f"scan_queue_{op_type}", {})
+    st.session_state.setdefault(f"scan_done_{op_type}", [])
     
     def on_scan():
         if st.session_state.scan_box:
-            process_stock(st.session_state.scan_box, qty, op_type)
+            sku = st.session_state.scan_box.strip()
+            if burst:
+                # 重複掃描同一 SKU 合併為一筆數量變動
+                queue = st.session_state[f"scan_queue_{op_type}"]
+                queue[sku] = queue.get(sku, 0) + qty
+            else:
+                process_stock(sku, qty, op_type)
             st.session_state.scan_box = ""
     
     st.text_input("掃描或輸入 SKU", key="scan_box", on_change=on_scan)
 
+    if burst:
+        @st.fragment(run_every=SCAN_FLUSH_INTERVAL)
+        def scan_queue_panel():
+            flush_scan_queue(op_type)
+            queue = st.session_state[f"scan_queue_{op_type}"]
+            history = st.session_state[f"scan_done_{op_type}"]
+            c1, c2 = st.columns(2)
+            c1.metric("待提交", f"{len(queue)} 項 / {sum(queue.values())} 件")
+            c2.metric("已處理", len(history))
+            if queue:
+                st.dataframe(pd.DataFrame([{"SKU": k, "數量": v} for k, v in queue.items()]), use_container_width=True)
+            if history:
+                with st.expander("提交結果"):
+                    st.dataframe(pd.DataFrame(history), use_container_width=True)
+
+        # 按下按鈕會重新執行頁面，由 scan_queue_panel 提交，避免同一次執行提交兩次
+        st.button("立即提交", type="primary")
+        scan_queue_panel()
+    elif st.session_state[f"scan_queue_{op_type}"]:
+        # 關閉連續掃描時未能提交的項目仍需顯示，避免暫存的異動被遺忘
+        queue = st.session_state[f"scan_queue_{op_type}"]
+        st.warning(f"尚有 {len(queue)} 項暫存掃描未提交")
+        st.dataframe(pd.DataFrame([{"SKU": k, "數量": v} for k, v in queue.items()]), use_container_width=True)
+        st.button("提交暫存", type="primary", on_click=flush_scan_queue, args=(op_type,))
+
+    metrics = get_stock_tx_metrics()
+    st.caption(f"交易 {metrics['commits']} 筆 · 衝突重試 {metrics['retries']} 次 · 退避 {metrics['backoffs']} 次 · 失敗 {metrics['failures']} 筆")
+
 def process_stock(sku, qty, op_type):
-    doc_ref = db.collection(COLLECTION_products).document(sku)
-    doc = doc_ref.get()
-    
-    if doc.exists:
-        data = doc.to_dict()
-        current = data.get('stock', 0)
-        new_stock = current + qty if op_type == "入庫" else current - qty
-        
-        if new_stock < 0:
-            st.error(f"庫存不足，目前: {current}")
-            return
-        
-        doc_ref.update({'stock': new_stock, 'updatedAt': firestore.SERVER_TIMESTAMP})
-        save_log({
-            "Time": get_taiwan_time(),
-            "User": "Admin",
-            "Type": op_type,
-            "SKU": sku,
-            "Name": data.get('name', ''),
-            "Quantity": qty,
-            "Note": ""
-        })
-        st.cache_data.clear()
+    delta = qty if op_type == "入庫" else -qty
+    status, value = adjust_stock(sku, delta, op_type)
+    if status == "ok":
         st.toast(f"{op_type}成功: {sku}")
-    else:
+    elif status == "insufficient":
+        st.error(f"庫存不足，目前: {value}")
+    elif status == "missing":
         st.error(f"SKU 不存在: {sku}")
+    else:
+        st.error(f"庫存更新失敗，請重試: {value}")
+
+def flush_scan_queue(op_type):
+    """將暫存的掃描一次提交；交易失敗的 SKU 保留在佇列中等待下次提交，並顯示錯誤而不中斷頁面"""
+    queue = st.session_state[f"scan_queue_{op_type}"]
+    if not queue:
+        return
+    deltas = {sku: (qty if op_type == "入庫" else -qty) for sku, qty in queue.items()}
+    results = adjust_stock_batch(deltas, op_type)
+    history = st.session_state[f"scan_done_{op_type}"]
+    failed = {}
+    for sku, (status, value) in results.items():
+        if status == "error":
+            failed[sku] = value
+            continue
+        qty = queue.pop(sku)
+        history.insert(0, {"SKU": sku, "數量": qty, "結果": {"ok": f"完成，庫存 {value}", "insufficient": f"庫存不足（{value}）", "missing": "SKU 不存在"}[status]})
+    del history[SCAN_HISTORY_LIMIT:]
+    if failed:
+        st.error(f"{len(failed)} 項提交失敗，已保留在待提交清單: {next(iter(failed.values()))}")
 
 def page_maintenance():
     # 標題樣式優化
@@ -1092,12 +2471,11 @@ def page_maintenance():
                             final_loc = selected_loc
                         
                         sku = f"{code}-{cat}-{num}" if all([code, cat, num]) else f"INS-{int(time.time())}"
-                        acc_json = json.dumps(acc_data, ensure_ascii=False) if acc_data else ""
                         
                         # 上傳圖片
-                        img_url = ""
+                        img_url, img_variants = "", {}
                         if uploaded_img:
-                            img_url = upload_image_to_firebase(uploaded_img, sku)
+                            img_url, img_variants = upload_image_to_firebase(uploaded_img, sku)
                             if not img_url:
                                 st.warning("圖片上傳失敗，但產品已建檔")
                         
@@ -1105,8 +2483,8 @@ def page_maintenance():
                             "SKU": sku, "Code": code, "Category": cat, "Number": num,
                             "Name": name, "SN": sn, "Location": final_loc, "Stock": stock,
                             "WarrantyStart": ws, "WarrantyEnd": we,
-                            "Accessories": acc_json, "ItemType": "儀器",
-                            "ImageFile": img_url
+                            "Accessories": acc_data, "ItemType": "儀器",
+                            "ImageFile": img_url or "", "ImageVariants": img_variants
                         })
                         st.success(f"已新增: {name}")
                         st.balloons()
@@ -1139,9 +2517,9 @@ def page_maintenance():
                         sku = f"CBL-{code}-{int(time.time())}" if code else f"CBL-{int(time.time())}"
                         
                         # 上傳圖片
-                        img_url = ""
+                        img_url, img_variants = "", {}
                         if uploaded_img:
-                            img_url = upload_image_to_firebase(uploaded_img , sku)
+                            img_url, img_variants = upload_image_to_firebase(uploaded_img , sku)
                             if not img_url:
                                 st.warning("圖片上傳失敗，但產品已建檔")
                         
@@ -1149,7 +2527,7 @@ def page_maintenance():
                             "SKU": sku, "Code": code, "Category": cat,
                             "Name": name, "Location": selected_loc_cable, "Stock": stock,
                             "ItemType": "線材",
-                            "ImageFile": img_url
+                            "ImageFile": img_url or "", "ImageVariants": img_variants
                         })
                         st.success(f"已新增: {name}")
 
@@ -1237,13 +2615,7 @@ def page_maintenance():
                         st.caption("編輯配件資訊（打勾並輸入數量）")
                         
                         # 解析既有配件
-                        existing_acc = {}
-                        acc_str = product_data.get('Accessories', '')
-                        if acc_str and pd.notna(acc_str):
-                            try:
-                                existing_acc = json.loads(acc_str)
-                            except:
-                                pass
+                        existing_acc = product_data.get('AccDict') or {}
                         
                         acc_data = {}
                         for cat_name, items in ACCESSORY_CATEGORIES.items():
@@ -1292,10 +2664,11 @@ def page_maintenance():
                             
                             # 上傳新圖片（如果有）
                             img_url = current_img_url
+                            img_variants = None
                             if uploaded_img:
-                                new_img_url = upload_image_to_firebase(uploaded_img, sku)
+                                new_img_url, new_variants = upload_image_to_firebase(uploaded_img, sku)
                                 if new_img_url:
-                                    img_url = new_img_url
+                                    img_url, img_variants = new_img_url, new_variants
                                     st.success("圖片已更新")
                                 else:
                                     st.warning("圖片上傳失敗，其他資訊已更新")
@@ -1313,16 +2686,17 @@ def page_maintenance():
                                 "ItemType": item_type,
                                 "ImageFile": img_url
                             }
+                            if img_variants is not None:
+                                update_data["ImageVariants"] = img_variants
                             
                             # 儀器特有欄位
                             if item_type == "儀器":
                                 update_data["WarrantyStart"] = ws
                                 update_data["WarrantyEnd"] = we
-                                update_data["Accessories"] = json.dumps(acc_data, ensure_ascii=False) if acc_data else ""
+                                update_data["Accessories"] = acc_data
                             
                             # 儲存
                             save_data_row(update_data)
-                            st.cache_data.clear()
                             st.success(f"✅ 已更新: {name}")
                             st.balloons()
                             time.sleep(1)
@@ -1330,8 +2704,7 @@ def page_maintenance():
                     
                     if delete_button:
                         # 刪除產品
-                        db.collection(COLLECTION_products).document(sku).delete()
-                        st.cache_data.clear()
+                        delete_product(sku)
                         st.success(f"🗑️ 已刪除: {name}")
                         time.sleep(1)
                         st.rerun()
@@ -1361,104 +2734,234 @@ def page_maintenance():
             st.markdown("---")
             f = st.file_uploader("上傳新圖片", type=["jpg","png"])
             if f and st.button("更新"):
-                url = upload_image_to_firebase(f, sel)
+                url, variants = upload_image_to_firebase(f, sel)
                 if url:
-                    db.collection(COLLECTION_products).document(sel).update({"imageFile": url})
-                    st.cache_data.clear()
+                    db.collection(COLLECTION_products).document(sel).update({"imageFile": url, "imageVariants": variants, "updatedAt": firestore.SERVER_TIMESTAMP})
+                    invalidate_product(sel, {"imageFile": url, "imageVariants": variants})
                     st.success("圖片已更新")
                     st.rerun()
 
     with tabs[3]:
-        st.markdown("##### CSV 匯入")
-        up_csv = st.file_uploader("選擇 CSV", type=["csv"])
+        st.markdown("##### CSV / Excel 匯入")
+        st.caption(f"大型檔案會以每 {IMPORT_CHUNK_ROWS} 列分塊讀取與寫入")
+        up_csv = st.file_uploader("選擇 CSV 或 Excel", type=["csv", "xlsx"])
         if up_csv:
-            df_im = pd.read_csv(up_csv)
-            st.dataframe(df_im.head())
+            # 只讀取前幾列作為預覽
+            preview = iter_import_chunks(up_csv, chunksize=5)
+            st.dataframe(next(preview, (pd.DataFrame(), 0))[0])
+            preview.close()
+            up_csv.seek(0)
             if st.button("匯入"):
-                for i, r in df_im.iterrows():
-                    save_data_row(r)
-                st.success("匯入完成")
+                bar = st.progress(0.0)
+                status = st.empty()
+
+                def on_progress(frac, written, error_count):
+                    bar.progress(frac)
+                    status.caption(f"已寫入 {written} 筆，錯誤 {error_count} 筆")
+
+                report = import_products_streaming(up_csv, progress=on_progress)
+                st.success(f"匯入完成：{report['written']} 筆，耗時 {report['elapsed']:.1f} 秒（{report['rate']:.0f} 筆/秒）")
+                if report['error_count']:
+                    st.warning(f"{report['error_count']} 筆未匯入" + (f"（僅列出前 {IMPORT_MAX_ERRORS} 筆）" if report['error_count'] > IMPORT_MAX_ERRORS else ""))
+                    st.dataframe(pd.DataFrame(report['errors']), use_container_width=True)
         
         st.markdown("---")
         st.markdown("##### 批次圖片上傳")
         st.caption("檔名可以是完整 SKU，或只包含部分關鍵字（程式會智能匹配）")
         imgs = st.file_uploader("選擇圖片", accept_multiple_files=True, key="batch_img")
         if imgs and st.button("上傳圖片"):
-            # 先載入所有產品的 SKU
-            all_products_df = load_data()
-            all_skus = all_products_df['SKU'].tolist()
+            # 檔名比對索引每次上傳建立一次
+            matcher = SkuMatcher(load_data()['SKU'].tolist())
             
-            bar = st.progress(0)
-            success_count = 0
-            fail_count = 0
+            items = []
             match_details = []
+            details = []
+            fail_count = 0
             
-            for i, f in enumerate(imgs):
+            for f in imgs:
                 filename = f.name.rsplit('.', 1)[0]  # 去掉副檔名
-                
-                # 智能匹配 SKU
-                matched_sku = None
-                match_type = None
-                
-                # 1. 精確匹配
-                if filename in all_skus:
-                    matched_sku = filename
-                    match_type = "精確"
-                else:
-                    # 2. 模糊匹配（忽略空格、大小寫）
-                    normalized_filename = filename.replace(" ", "").replace("-", "").lower()
-                    for sku in all_skus:
-                        normalized_sku = sku.replace(" ", "").replace("-", "").lower()
-                        if normalized_filename == normalized_sku:
-                            matched_sku = sku
-                            match_type = "模糊"
-                            break
-                    
-                    # 3. 部分匹配（檔名包含在 SKU 中）
-                    if not matched_sku:
-                        for sku in all_skus:
-                            if filename in sku:
-                                matched_sku = sku
-                                match_type = "部分"
-                                break
-                
+                matched_sku, match_type, n_candidates = matcher.match(filename)
                 if matched_sku:
-                    # 上傳圖片到 R2
-                    url = upload_image_to_firebase(f, matched_sku)
-                    
-                    if url:
-                        # 更新資料庫
-                        try:
-                            db.collection(COLLECTION_products).document(matched_sku).update({"imageFile": url})
-                            success_count += 1
-                            match_details.append(f"✅ {filename} → {matched_sku} ({match_type}匹配)")
-                        except Exception as e:
-                            fail_count += 1
-                            match_details.append(f"⚠️ {filename}: 圖片已上傳但資料庫更新失敗")
-                    else:
-                        fail_count += 1
-                        match_details.append(f"❌ {filename}: 圖片上傳失敗")
+                    if n_candidates > 1:
+                        match_type += f"，{n_candidates} 個候選"
+                    items.append((matched_sku, f.getvalue()))
+                    match_details.append((filename, match_type))
                 else:
                     fail_count += 1
-                    match_details.append(f"❌ {filename}: 找不到對應的產品 SKU")
-                
-                bar.progress((i+1)/len(imgs))
+                    details.append(f"❌ {filename}: 找不到對應的產品 SKU")
+            
+            bar = st.progress(0.0)
+            status = st.empty()
+            
+            def on_progress(done, total):
+                bar.progress(done / total)
+                status.caption(f"已處理 {done} / {total} 張")
+            
+            start = time.perf_counter()
+            results = upload_images_batch(items, progress=on_progress) if items else []
+            elapsed = time.perf_counter() - start
+            
+            success_count = 0
+            for (sku, url, err), (filename, match_type) in zip(results, match_details):
+                if url:
+                    success_count += 1
+                    details.append(f"✅ {filename} → {sku} ({match_type}匹配)")
+                else:
+                    fail_count += 1
+                    details.append(f"❌ {filename}: {err}")
             
             # 顯示結果
-            st.cache_data.clear()
-            st.success(f"✅ 完成！成功 {success_count} 筆，失敗 {fail_count} 筆")
+            st.success(f"✅ 完成！成功 {success_count} 筆，失敗 {fail_count} 筆，耗時 {elapsed:.1f} 秒")
             
             # 顯示詳細匹配結果
             with st.expander("查看詳細匹配結果"):
-                for detail in match_details:
+                for detail in details:
                     st.text(detail)
             
             if success_count > 0:
                 st.rerun()
 
+def taiwan_day_start(d):
+    return datetime.combine(d, datetime.min.time(), tzinfo=timezone(timedelta(hours=8)))
+
 def page_reports():
     st.markdown("### 異動紀錄")
-    st.dataframe(load_log(), use_container_width=True)
+    tab_logs, tab_rollups = st.tabs(["📜 明細", "📊 每日彙總"])
+    with tab_logs:
+        render_log_browser()
+    with tab_rollups:
+        render_rollups()
+
+def render_log_browser():
+    f1, f2, f3 = st.columns([1, 1, 2])
+    sku = f1.text_input("SKU", placeholder="全部").strip()
+    op_type = f2.selectbox("類型", ["全部"] + LOG_TYPES)
+    dates = f3.date_input("日期區間", value=(), max_value=get_taiwan_date())
+    start = taiwan_day_start(dates[0]) if len(dates) >= 1 else None
+    end = taiwan_day_start(dates[-1] + timedelta(days=1)) if len(dates) >= 1 else None
+    op_type = None if op_type == "全部" else op_type
+
+    # 篩選條件改變時回到第一頁；log_cursors 為每一頁起點的游標堆疊
+    filter_key = (sku, op_type, start, end)
+    if st.session_state.get("log_filter_key") != filter_key:
+        st.session_state.log_filter_key = filter_key
+        st.session_state.log_cursors = [None]
+    cursors = st.session_state.log_cursors
+
+    try:
+        logs, next_cursor = query_logs_page(sku, op_type, start, end, cursors[-1])
+    except Exception as e:
+        st.error(f"紀錄讀取失敗（若為缺少索引，請依錯誤訊息中的連結建立複合索引）: {e}")
+        return
+
+    st.dataframe(logs, use_container_width=True, hide_index=True)
+
+    n1, n2, n3 = st.columns([1, 2, 1])
+    if n1.button("← 較新", disabled=len(cursors) <= 1, use_container_width=True):
+        cursors.pop()
+        st.rerun()
+    n2.caption(f"第 {len(cursors)} 頁 · 每頁 {LOG_PAGE_SIZE} 筆")
+    if n3.button("較舊 →", disabled=next_cursor is None, use_container_width=True):
+        cursors.append(next_cursor)
+        st.rerun()
+
+    with st.expander("📤 匯出紀錄（依上方日期區間）"):
+        render_log_export(start, end)
+
+def render_rollups():
+    """由每日彙總回答「某品項近 N 天用量」，只讀取區間內的彙總文件"""
+    today = get_taiwan_date()
+    c1, c2 = st.columns([1, 2])
+    days = c1.selectbox("期間", [7, 30, 90, 180, 365], index=2, format_func=lambda d: f"近 {d} 天")
+    keyword = c2.text_input("品項 / 分類 / SKU 關鍵字", placeholder="例如：傳輸線").strip()
+
+    rollups = query_rollups(str(today - timedelta(days=days - 1)), str(today))
+    if keyword:
+        text = rollups["SKU"].astype(str)
+        for col in ["Name", "Category", "ItemType"]:
+            text = text + " " + rollups[col].astype(str)
+        rollups = rollups[text.str.contains(keyword, case=False, regex=False)]
+
+    if rollups.empty:
+        st.info("此期間沒有異動彙總")
+    else:
+        m1, m2, m3 = st.columns(3)
+        m1.metric("入庫總量", int(rollups["inQty"].sum()))
+        m2.metric("出庫總量", int(rollups["outQty"].sum()))
+        m3.metric("涉及品項", rollups["SKU"].nunique())
+        st.line_chart(rollups.groupby("date")[["inQty", "outQty"]].sum())
+        by_sku = (rollups.groupby(["SKU", "Name", "Location"], as_index=False)[["inQty", "outQty", "count"]].sum()
+                  .sort_values("outQty", ascending=False))
+        st.dataframe(by_sku, use_container_width=True, hide_index=True)
+
+    with st.expander("🛠️ 重建彙總"):
+        st.caption("由完整異動紀錄重新計算所有彙總，僅在資料不一致或首次啟用時需要。")
+        if st.button("從完整紀錄重建", key="rebuild_rollups"):
+            status = st.empty()
+            count = rebuild_rollups(progress=lambda n: status.caption(f"已讀取 {n} 筆紀錄..."))
+            st.success(f"已重建 {count} 筆彙總")
+
+LOG_EXPORT_MAX_ROWS = 200_000  # 網頁下載會把整個檔案讀入記憶體，超過此筆數請改用 export_logs.py
+LOG_EXPORT_PREFIX = "inventory_logs_"
+LOG_EXPORT_TTL = 3600  # 產生後未下載的匯出檔保留秒數
+
+def _sweep_log_exports():
+    """刪除逾時未下載的匯出暫存檔（工作階段結束時不會自動清除）"""
+    tmp_dir = tempfile.gettempdir()
+    cutoff = time.time() - LOG_EXPORT_TTL
+    for name in os.listdir(tmp_dir):
+        if not name.startswith(LOG_EXPORT_PREFIX):
+            continue
+        path = os.path.join(tmp_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def _serve_log_export(path):
+    """download_button 的延遲資料：按下下載時才讀入檔案，讀完即刪除暫存檔"""
+    def read():
+        with open(path, "rb") as f:
+            data = f.read()
+        os.remove(path)
+        return data
+    return read
+
+def render_log_export(start, end):
+    """分批寫入暫存檔，按下下載時才讀入並刪除暫存檔；超過 LOG_EXPORT_MAX_ROWS 筆時改用 export_logs.py"""
+    fmt = st.radio("格式", ["csv", "parquet"], horizontal=True, key="log_export_fmt")
+    if st.button("產生匯出檔", key="log_export_run"):
+        old = st.session_state.pop("log_export_path", None)
+        if old and os.path.exists(old): os.remove(old)
+        _sweep_log_exports()
+        total = count_logs(db, start, end, collection=COLLECTION_logs)
+        if total > LOG_EXPORT_MAX_ROWS:
+            args = " ".join(f"--{k} {v:%Y-%m-%d}" for k, v in (("start", start), ("end", end)) if v)
+            st.warning(f"共 {total} 筆，超過網頁下載上限 {LOG_EXPORT_MAX_ROWS} 筆，請在伺服器上執行：")
+            st.code(f"python export_logs.py consumables_logs.{fmt} {args}".strip())
+            return
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}", prefix=LOG_EXPORT_PREFIX)
+        os.close(fd)
+        status = st.empty()
+        try:
+            total = export_logs(db, path, fmt, start, end, collection=COLLECTION_logs,
+                                progress=lambda n: status.caption(f"已匯出 {n} 筆..."))
+        except Exception as e:
+            os.remove(path)
+            st.error(f"匯出失敗: {e}")
+            return
+        status.caption(f"共 {total} 筆")
+        st.session_state.log_export_path = path
+
+    path = st.session_state.get("log_export_path")
+    if path and not os.path.exists(path):
+        # 已下載（暫存檔已刪除）或逾時被清除
+        del st.session_state["log_export_path"]
+    elif path:
+        ext = os.path.splitext(path)[1]
+        st.download_button("下載匯出檔", _serve_log_export(path), file_name=f"consumables_logs_{get_taiwan_date()}{ext}",
+                           key="log_export_download", on_click="ignore")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
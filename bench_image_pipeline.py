@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+比較舊版與新版圖片處理流程的耗時與記憶體峰值
+
+每個版本、每張圖片都在獨立子行程中執行，峰值 RSS 互不影響。
+未指定圖片時會產生一張 20MP（5472×3648）的測試 JPEG。
+
+用法：
+    python bench_image_pipeline.py                 # 使用產生的測試圖片
+    python bench_image_pipeline.py a.jpg b.jpg     # 使用實際照片
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import tempfile
+
+RUNS = 3
+
+def old_pipeline(data):
+    """改版前 upload_image_to_firebase 的處理方式：完整解碼後 LANCZOS 縮到 800px"""
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    if image.mode in ("RGBA", "P"): image = image.convert("RGB")
+    max_width = 800
+    if image.width > max_width:
+        ratio = max_width / float(image.width)
+        new_height = int(float(image.height) * ratio)
+        image = image.resize((max_width, new_height), Image.Resampling.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=80)
+    return out.getvalue()
+
+def new_pipeline(data):
+    from image_utils import encode_product_image
+    return encode_product_image(data)
+
+def renditions_pipeline(data):
+    from image_utils import render_product_images
+    return render_product_images(data)
+
+PIPELINES = {"舊版": old_pipeline, "新版": new_pipeline, "新版（全部縮圖）": renditions_pipeline}
+
+def run_worker(name, path):
+    """子行程：執行指定流程並輸出 JSON（耗時秒數、峰值 RSS MB）"""
+    with open(path, "rb") as f:
+        data = f.read()
+    func = PIPELINES[name]
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        func(data)
+        times.append(time.perf_counter() - start)
+    print(json.dumps({"time": min(times), "rss": peak_rss_mb()}))
+
+def peak_rss_mb():
+    # Linux 的 ru_maxrss 會繼承 fork 前父行程的峰值，優先讀取 exec 後重新計算的 VmHWM
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss 在 Linux 單位為 KB，macOS 為 bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+def make_test_image(path, size=(5472, 3648)):
+    """產生帶雜訊的測試照片（純色圖片壓縮後太小，無法反映真實解碼成本）"""
+    from PIL import Image
+    noise = Image.effect_noise(size, 64).convert("RGB")
+    gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+    Image.blend(noise, gradient, 0.5).save(path, format="JPEG", quality=90)
+
+def measure(name, path):
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", name, path],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="圖片處理效能比較")
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.images[0])
+        return
+
+    images = args.images
+    tmp = None
+    if not images:
+        tmp = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+        tmp.close()
+        make_test_image(tmp.name)
+        images = [tmp.name]
+
+    print("=" * 70)
+    print(f"圖片處理效能比較（每項取 {RUNS} 次中最快者）")
+    print("=" * 70)
+    try:
+        for path in images:
+            print(f"\n📷 {os.path.basename(path)} ({os.path.getsize(path) / 1024 / 1024:.1f} MB)")
+            baseline = None
+            for name in PIPELINES:
+                result = measure(name, path)
+                baseline = baseline or result
+                speedup = baseline["time"] / result["time"] if result["time"] else 0
+                print(f"  {name:<12} {result['time'] * 1000:8.1f} ms   峰值 RSS {result['rss']:7.1f} MB   ×{speedup:.1f}")
+    finally:
+        if tmp:
+            os.remove(tmp.name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+分段匯出 consumables_logs 異動紀錄為 CSV / Parquet
+
+以 timestamp 游標逐批讀取並逐批寫出，記憶體用量只與批次大小有關，
+適合月度稽核時匯出數十萬筆紀錄。
+
+用法：
+    python export_logs.py logs_2026-09.csv --start 2026-09-01 --end 2026-10-01
+    python export_logs.py logs.parquet --format parquet
+"""
+
+import csv
+import sys
+import argparse
+from datetime import datetime, timedelta, timezone
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+# Firebase 設定
+FIREBASE_KEY_PATH = "product-system-900c4-firebase-adminsdk-fbsvc-305a38d463.json"
+COLLECTION_NAME = "consumables_logs"
+
+LOG_FIELDS = ["Time", "User", "Type", "SKU", "Name", "Location", "Quantity", "Note", "timestamp"]
+EXPORT_CHUNK_SIZE = 1000
+TAIWAN_TZ = timezone(timedelta(hours=8))
+
+def init_firebase():
+    """初始化 Firebase"""
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(FIREBASE_KEY_PATH)
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+def _log_query(db, start=None, end=None, collection=COLLECTION_NAME):
+    query = db.collection(collection)
+    if start:
+        query = query.where("timestamp", ">=", start)
+    if end:
+        query = query.where("timestamp", "<", end)
+    return query
+
+def count_logs(db, start=None, end=None, collection=COLLECTION_NAME):
+    """以 count 聚合查詢計算區間內的紀錄數，不讀取文件內容"""
+    return int(_log_query(db, start, end, collection).count().get()[0][0].value)
+
+def iter_log_chunks(db, start=None, end=None, chunk_size=EXPORT_CHUNK_SIZE, collection=COLLECTION_NAME):
+    """依 timestamp 由舊到新逐批讀取紀錄，每批 yield 一個 dict list"""
+    query = _log_query(db, start, end, collection).order_by("timestamp").limit(chunk_size)
+
+    last_doc = None
+    while True:
+        page = query.start_after(last_doc) if last_doc is not None else query
+        docs = list(page.stream())
+        if not docs:
+            return
+        yield [doc.to_dict() for doc in docs]
+        if len(docs) < chunk_size:
+            return
+        last_doc = docs[-1]
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.astimezone(TAIWAN_TZ).isoformat()
+    return "" if value is None else value
+
+def write_logs_csv(chunks, fileobj):
+    """逐批寫入 CSV（fileobj 為文字模式），回傳筆數"""
+    writer = csv.DictWriter(fileobj, fieldnames=LOG_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    count = 0
+    for rows in chunks:
+        writer.writerows({k: _csv_value(row.get(k)) for k in LOG_FIELDS} for row in rows)
+        count += len(rows)
+    return count
+
+def _quantity(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def write_logs_parquet(chunks, path):
+    """逐批寫入 Parquet（每批一個 row group），需要 pyarrow，回傳筆數"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("匯出 Parquet 需要安裝 pyarrow")
+
+    schema = pa.schema(
+        [(k, pa.string()) for k in LOG_FIELDS if k not in ("Quantity", "timestamp")]
+        + [("Quantity", pa.int64()), ("timestamp", pa.timestamp("us", tz="UTC"))]
+    )
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in chunks:
+            columns = {}
+            for field in schema:
+                if field.name == "Quantity":
+                    columns[field.name] = [_quantity(r.get("Quantity")) for r in rows]
+                elif field.name == "timestamp":
+                    columns[field.name] = [r.get("timestamp") for r in rows]
+                else:
+                    columns[field.name] = [None if r.get(field.name) is None else str(r.get(field.name)) for r in rows]
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            count += len(rows)
+    return count
+
+def export_logs(db, path, fmt="csv", start=None, end=None, chunk_size=EXPORT_CHUNK_SIZE,
+                collection=COLLECTION_NAME, progress=None):
+    """匯出紀錄至檔案，progress(count) 於每批寫出後呼叫，回傳總筆數"""
+    def chunks():
+        done = 0
+        for rows in iter_log_chunks(db, start, end, chunk_size, collection):
+            yield rows
+            done += len(rows)
+            if progress:
+                progress(done)
+
+    if fmt == "parquet":
+        return write_logs_parquet(chunks(), path)
+    # utf-8-sig 讓 Excel 正確顯示中文
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        return write_logs_csv(chunks(), f)
+
+def _parse_day(text):
+    return datetime.strptime(text, "%Y-%m-%d").replace(tzinfo=TAIWAN_TZ)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="匯出異動紀錄")
+    parser.add_argument("output", help="輸出檔案路徑")
+    parser.add_argument("--format", choices=["csv", "parquet"], help="預設依副檔名判斷")
+    parser.add_argument("--start", help="起始日期 YYYY-MM-DD（含）")
+    parser.add_argument("--end", help="結束日期 YYYY-MM-DD（不含）")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("parquet" if args.output.endswith(".parquet") else "csv")
+    start = _parse_day(args.start) if args.start else None
+    end = _parse_day(args.end) if args.end else None
+
+    print("=" * 50)
+    print(f"匯出異動紀錄 → {args.output} ({fmt})")
+    print("=" * 50)
+
+    db = init_firebase()
+    total = export_logs(db, args.output, fmt, start, end, args.chunk_size,
+                        progress=lambda n: print(f"  已匯出 {n} 筆", end="\r"))
+    print(f"\n✅ 完成，共 {total} 筆")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
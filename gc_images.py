@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+回收 Cloudflare R2 中不再被任何產品 imageFile / imageVariants 參照的圖片
+
+圖片以內容雜湊命名（images/{sha256}.jpg / .webp / .avif），同一物件可能被多個 SKU 共用，
+因此先統計每個物件的參照數，只刪除參照數為 0 的物件。
+剛上傳、尚未寫入資料庫的物件以寬限期保護。
+
+執行方式：
+    python gc_images.py            # 只列出可回收的物件
+    python gc_images.py --delete   # 實際刪除
+"""
+
+import os
+import sys
+import argparse
+import urllib.parse
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import tomllib
+import firebase_admin
+from firebase_admin import credentials, firestore
+from r2_client import get_r2_client
+
+# Firebase 設定
+FIREBASE_KEY_PATH = "product-system-900c4-firebase-adminsdk-fbsvc-305a38d463.json"
+COLLECTION_NAME = "instrument_consumables"
+
+# Cloudflare R2 設定 - 從 secrets.toml 讀取
+secrets_path = os.path.join(os.path.dirname(__file__), ".streamlit", "secrets.toml")
+with open(secrets_path, "rb") as f:
+    secrets = tomllib.load(f)
+
+r2_conf = secrets.get("cloudflare", {})
+R2_ENDPOINT = r2_conf.get("endpoint", "")
+R2_ACCESS_KEY = r2_conf.get("access_key", "")
+R2_SECRET_KEY = r2_conf.get("secret_key", "")
+R2_BUCKET_NAME = r2_conf.get("bucket_name", "")
+R2_PUBLIC_DOMAIN = r2_conf.get("public_domain", "")
+
+IMAGE_PREFIX = "images/"
+GRACE_DAYS = 7  # 寬限期內的物件不刪除（上傳後才更新資料庫、或仍有舊頁面引用）
+DELETE_BATCH = 1000  # delete_objects 單次上限
+
+def init_firebase():
+    """初始化 Firebase"""
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(FIREBASE_KEY_PATH)
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+def is_external_url(url):
+    """不屬於 R2 的圖片（Firebase Storage、data URI），不需要也無法轉成 R2 key"""
+    return url.startswith("data:") or "storage.googleapis.com" in url or "firebasestorage.app" in url
+
+def url_to_key(url):
+    """將 imageFile 轉為 R2 物件 key（已解碼 %XX，不含開頭的 /）；無法判斷時回傳 None"""
+    if not url or url.lower() in ("none", "nan"):
+        return None
+    parsed = urllib.parse.urlparse(url)
+    if not parsed.netloc:
+        # 相對路徑：images/a.jpg 或 /images/a.jpg
+        return urllib.parse.unquote(parsed.path).lstrip("/") or None
+    path = urllib.parse.unquote(parsed.path).lstrip("/")
+    public_netloc = urllib.parse.urlparse(R2_PUBLIC_DOMAIN).netloc if R2_PUBLIC_DOMAIN else ""
+    if (public_netloc and parsed.netloc == public_netloc) or parsed.netloc.endswith("r2.dev"):
+        return path or None
+    if parsed.netloc.endswith("r2.cloudflarestorage.com"):
+        path = path[len(R2_BUCKET_NAME) + 1:] if path.startswith(R2_BUCKET_NAME + "/") else path
+        return path or None
+    return None
+
+def doc_image_urls(data):
+    """產品文件參照的所有圖片 URL：imageFile 與各尺寸、格式的縮圖（同一物件只算一次）
+
+    縮圖只在最大尺寸的 JPEG 等於 imageFile 時才算參照，imageFile 被其他流程改掉後舊縮圖即可回收。
+    """
+    image_file = data.get("imageFile", "")
+    urls = {image_file}
+    variants = data.get("imageVariants")
+    if isinstance(variants, dict) and variants:
+        largest = variants.get(max(variants, key=int))
+        if isinstance(largest, dict) and largest.get("jpeg") == image_file:
+            for by_fmt in variants.values():
+                urls.update(by_fmt.values())
+    return urls
+
+def count_references(db):
+    """統計每個 R2 物件被多少產品參照，回傳 (參照統計, 無法轉成 key 的 [(SKU, URL)])"""
+    refs = Counter()
+    unresolved = []
+    for doc in db.collection(COLLECTION_NAME).select(["imageFile", "imageVariants"]).stream():
+        for url in doc_image_urls(doc.to_dict()):
+            if not url or str(url).lower() in ("none", "nan") or is_external_url(url):
+                continue
+            key = url_to_key(url)
+            if key:
+                refs[key] += 1
+            else:
+                unresolved.append((doc.id, url))
+    return refs, unresolved
+
+def iter_r2_objects(r2_client, prefix=IMAGE_PREFIX):
+    paginator = r2_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=R2_BUCKET_NAME, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+def find_garbage(db, r2_client, cutoff):
+    """回傳 (可回收物件清單, 參照統計, 寬限期內略過數, 無法轉成 key 的 URL)；cutoff 之後修改的物件不回收"""
+    refs, unresolved = count_references(db)
+    garbage, recent = [], 0
+    for obj in iter_r2_objects(r2_client):
+        if refs.get(obj["Key"], 0) > 0:
+            continue
+        if obj["LastModified"] > cutoff:
+            recent += 1
+            continue
+        garbage.append(obj)
+    return garbage, refs, recent, unresolved
+
+def recheck_garbage(db, r2_client, keys, cutoff):
+    """刪除前重新確認仍可回收的 key
+
+    統計參照之後才有產品重新使用的物件會被排除：app 重新使用既有物件時會先更新 LastModified 再寫入資料庫，
+    因此先重新統計參照、再重新列出物件，兩者之一必定看得到這次重新使用。
+    """
+    refs, _ = count_references(db)
+    modified = {obj["Key"]: obj["LastModified"] for obj in iter_r2_objects(r2_client)}
+    return [k for k in keys if refs.get(k, 0) == 0 and k in modified and modified[k] <= cutoff]
+
+def delete_objects(db, r2_client, keys, cutoff):
+    deleted = skipped = 0
+    for i in range(0, len(keys), DELETE_BATCH):
+        batch = keys[i:i + DELETE_BATCH]
+        still = recheck_garbage(db, r2_client, batch, cutoff)
+        skipped += len(batch) - len(still)
+        if not still:
+            continue
+        resp = r2_client.delete_objects(
+            Bucket=R2_BUCKET_NAME,
+            Delete={"Objects": [{"Key": k} for k in still], "Quiet": True}
+        )
+        for err in resp.get("Errors", []):
+            print(f"  ❌ {err.get('Key')}: {err.get('Message')}")
+        deleted += len(still) - len(resp.get("Errors", []))
+    if skipped:
+        print(f"  ↩️  {skipped} 個物件在掃描後被重新使用，已略過")
+    return deleted
+
+def gc_images(delete=False, grace_days=GRACE_DAYS):
+    print("=" * 50)
+    print("回收未參照的 R2 圖片")
+    print("=" * 50)
+
+    db = init_firebase()
+    r2_client = get_r2_client(R2_ENDPOINT, R2_ACCESS_KEY, R2_SECRET_KEY)
+    cutoff = datetime.now(timezone.utc) - timedelta(days=grace_days)
+    garbage, refs, recent, unresolved = find_garbage(db, r2_client, cutoff)
+
+    shared = sum(1 for n in refs.values() if n > 1)
+    size = sum(obj["Size"] for obj in garbage)
+    print("\n📊 統計總覽")
+    print(f"  被參照的物件: {len(refs)}（其中 {shared} 個由多個 SKU 共用）")
+    print(f"  寬限期（{grace_days} 天）內略過: {recent}")
+    print(f"  可回收: {len(garbage)} 個，共 {size / 1024 / 1024:.1f} MB")
+    for obj in garbage[:10]:  # 只顯示前 10 筆
+        print(f"  - {obj['Key']} ({obj['LastModified']:%Y-%m-%d})")
+
+    if unresolved:
+        # 無法確定這些 URL 指向哪個物件，刪除可能誤刪仍在使用的圖片
+        print(f"\n⚠️  {len(unresolved)} 個圖片 URL 無法轉成 R2 key：")
+        for sku, url in unresolved[:10]:
+            print(f"  - {sku}: {url}")
+        if delete:
+            print("\n❌ 已中止刪除，請先修正上述 URL 或 R2 設定")
+            return 0
+
+    if not delete or not garbage:
+        if garbage:
+            print("\n提示：加上 --delete 參數才會實際刪除")
+        return 0
+
+    deleted = delete_objects(db, r2_client, [obj["Key"] for obj in garbage], cutoff)
+    print(f"\n✅ 已刪除 {deleted} 個物件")
+    return deleted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="回收未參照的 R2 圖片")
+    parser.add_argument("--delete", action="store_true", help="實際刪除（預設只列出）")
+    parser.add_argument("--grace-days", type=int, default=GRACE_DAYS)
+    args = parser.parse_args()
+
+    if args.delete:
+        print("\n⚠️  警告：此操作將永久刪除未被任何產品參照的 R2 圖片")
+        confirm = input("\n確定要繼續嗎？(輸入 yes 確認): ")
+        if confirm.lower() != "yes":
+            print("❌ 已取消操作")
+            sys.exit(0)
+    gc_images(delete=args.delete, grace_days=args.grace_days)
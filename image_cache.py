@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+圖片代理用的磁碟 LRU 快取
+
+以「穩定 URL」（資料庫中的 imageFile / 縮圖 URL，而非每小時變動的簽名 URL）的 sha256 為檔名，
+原圖只下載一次；總大小超過上限時依最後使用時間淘汰。
+st.image 需要完整的 bytes，因此命中時直接讀取整個檔案（重複讀取由作業系統的 page cache 提供）。
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+CACHE_EVICT_RATIO = 0.9  # 超過上限時淘汰到上限的 90%，避免每次寫入都觸發淘汰
+
+class DiskImageCache:
+    """以 URL 為鍵、大小有上限的磁碟快取，可跨執行緒共用"""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._fetching = {}  # key → Lock，避免同一張圖片同時下載多次
+        self._entries = OrderedDict()  # key → 檔案大小，依最後使用時間排序（舊 → 新）
+        self._size = 0
+        os.makedirs(root, exist_ok=True)
+        # 重新啟動時以檔案修改時間還原 LRU 順序
+        files = []
+        for name in os.listdir(root):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(root, name))
+                continue
+            st = os.stat(os.path.join(root, name))
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def get(self, url, fetch):
+        """回傳 url 的內容；未快取時呼叫 fetch() 取得 bytes 並寫入快取"""
+        key = self.key(url)
+        with self._lock:
+            hit = key in self._entries
+            if hit:
+                self._entries.move_to_end(key)
+        if hit:
+            data = self._read(key)
+            if data is not None:
+                return data
+        with self._lock:
+            fetch_lock = self._fetching.setdefault(key, threading.Lock())
+        try:
+            with fetch_lock:
+                # 等待期間其他執行緒可能已下載完成
+                if key in self._entries:
+                    data = self._read(key)
+                    if data is not None:
+                        return data
+                data = fetch()
+                self._store(key, data)
+                return data
+        finally:
+            with self._lock:
+                self._fetching.pop(key, None)
+
+    def _store(self, key, data):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            if self._size > self.max_bytes:
+                self._evict(int(self.max_bytes * CACHE_EVICT_RATIO))
+
+    def _evict(self, target):
+        while self._entries and self._size > target:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes}
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+產品圖片處理（解碼、縮圖、編碼 JPEG）
+
+只依賴 Pillow，不引用 streamlit 或 Firebase，
+因此可以在 ProcessPoolExecutor 的子行程中執行批次處理。
+
+大張照片先以 JPEG draft 在解碼時縮小（1/2、1/4、1/8），再以 reducing_gap 先用 reduce
+粗縮、最後才做 LANCZOS，避免整張 2000 萬像素影像解碼到記憶體。效能比較見 bench_image_pipeline.py。
+"""
+
+import io
+from PIL import Image, ImageOps
+
+IMAGE_MAX_WIDTH = 800
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+AVIF_QUALITY = 60
+IMAGE_RENDITION_WIDTHS = (800, 300, 64)  # 由大到小逐級縮小，只需解碼一次
+IMAGE_MAX_PIXELS = 64_000_000  # 超過此像素數的檔案直接拒絕（防止解壓縮炸彈耗盡記憶體）
+IMAGE_REDUCING_GAP = 3.0  # 縮小超過 3 倍時先以 reduce 整數倍粗縮
+EXIF_ORIENTATION = 0x0112
+
+def _avif_supported():
+    try:
+        from PIL import features
+        return bool(features.check("avif"))
+    except Exception:
+        return False
+
+# 輸出格式 → Pillow 儲存參數；AVIF 僅在 Pillow 支援時產生
+IMAGE_FORMATS = {
+    "jpeg": {"format": "JPEG", "quality": JPEG_QUALITY},
+    "webp": {"format": "WEBP", "quality": WEBP_QUALITY, "method": 4},
+}
+if _avif_supported():
+    IMAGE_FORMATS["avif"] = {"format": "AVIF", "quality": AVIF_QUALITY}
+
+def open_product_image(source, max_width=IMAGE_MAX_WIDTH):
+    """開啟上傳的圖片：檢查像素上限、JPEG 以 draft 在解碼時縮小、依 EXIF 方向轉正，並轉為 RGB / L"""
+    image = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    if image.width * image.height > IMAGE_MAX_PIXELS:
+        raise ValueError(f"圖片像素過大（{image.width}×{image.height}）")
+    if image.format == "JPEG":
+        # 旋轉 90 度的照片，轉正後的寬度是目前的高度
+        rotated = image.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8)
+        width = image.height if rotated else image.width
+        if width > max_width:
+            scale = max_width / width
+            # draft 會選擇不小於要求尺寸的最小縮放比例
+            image.draft("RGB", (max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "L"): image = image.convert("RGB")
+    return image
+
+def _fit_width(image, width):
+    if image.width <= width:
+        return image
+    ratio = width / float(image.width)
+    new_height = max(1, int(float(image.height) * ratio))
+    return image.resize((width, new_height), Image.Resampling.LANCZOS, reducing_gap=IMAGE_REDUCING_GAP)
+
+def _encode(image, fmt):
+    out = io.BytesIO()
+    image.save(out, **IMAGE_FORMATS[fmt])
+    return out.getvalue()
+
+def render_product_images(source, widths=IMAGE_RENDITION_WIDTHS, formats=None):
+    """一次解碼產生多種尺寸與格式，回傳 {寬度字串: {格式: bytes}}
+
+    每一級由上一級縮小而來；原圖比目標寬度小時不放大。
+    """
+    widths = sorted(widths, reverse=True)
+    image = open_product_image(source, widths[0])
+    renditions = {}
+    for width in widths:
+        image = _fit_width(image, width)
+        renditions[str(width)] = {fmt: _encode(image, fmt) for fmt in (formats or IMAGE_FORMATS)}
+    return renditions
+
+def encode_product_image(source, max_width=IMAGE_MAX_WIDTH):
+    """將上傳的圖片（bytes 或檔案物件）轉為 RGB、縮到最大寬度並編碼為 JPEG bytes"""
+    return _encode(_fit_width(open_product_image(source, max_width), max_width), "jpeg")
@@ -7,10 +7,10 @@
 import json
 import time
 import io
-import boto3
 from PIL import Image
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
+from r2_client import get_r2_client
 
 # ==========================================
 # 配置
@@ -55,13 +55,8 @@ def init_firebase():
     return db, bucket
 
 def init_r2():
-    """初始化 Cloudflare R2 客戶端"""
-    return boto3.client(
-        's3',
-        endpoint_url=R2_ENDPOINT,
-        aws_access_key_id=R2_ACCESS_KEY,
-        aws_secret_access_key=R2_SECRET_KEY
-    )
+    """初始化 Cloudflare R2 客戶端（共用連線池）"""
+    return get_r2_client(R2_ENDPOINT, R2_ACCESS_KEY, R2_SECRET_KEY)
 
 # ==========================================
 # 遷移邏輯
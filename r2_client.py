@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+共用的 Cloudflare R2（S3 相容）客戶端
+
+同一組連線參數在整個行程內只建立一次 client，重複使用其連線池，
+避免每次上傳都重新建立 session、解析 endpoint 並進行 TLS 交握。
+boto3 的 client 可安全地跨執行緒共用。
+
+設定環境變數 R2_ENDPOINT_URL 可改連本機的 S3 相容服務（例如 moto_server、MinIO）做測試。
+"""
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+R2_MAX_POOL_CONNECTIONS = 32  # 與批次上傳的執行緒數相當
+R2_MAX_ATTEMPTS = 5
+R2_CONNECT_TIMEOUT = 5
+R2_READ_TIMEOUT = 60
+
+_clients = {}
+_lock = threading.Lock()
+
+def r2_config(max_pool_connections=R2_MAX_POOL_CONNECTIONS):
+    """連線池、adaptive 重試與 TCP keep-alive 設定"""
+    return Config(
+        max_pool_connections=max_pool_connections,
+        retries={"max_attempts": R2_MAX_ATTEMPTS, "mode": "adaptive"},
+        tcp_keepalive=True,
+        connect_timeout=R2_CONNECT_TIMEOUT,
+        read_timeout=R2_READ_TIMEOUT,
+        signature_version="s3v4",
+    )
+
+def get_r2_client(endpoint, access_key, secret_key, max_pool_connections=R2_MAX_POOL_CONNECTIONS):
+    """依連線參數回傳快取的 client，第一次呼叫時才建立"""
+    endpoint = os.environ.get("R2_ENDPOINT_URL") or endpoint
+    key = (endpoint, access_key, secret_key, max_pool_connections)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            # 每個 client 使用獨立 session，避免共用 boto3 預設 session 的執行緒安全問題
+            client = boto3.session.Session().client(
+                "s3",
+                endpoint_url=endpoint,
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                region_name="auto",
+                config=r2_config(max_pool_connections),
+            )
+            _clients[key] = client
+    return client
+
+def r2_client_from_conf(conf):
+    """由 secrets 的 [cloudflare] 區段取得 client"""
+    return get_r2_client(conf["endpoint"], conf["access_key"], conf["secret_key"])